@@ -0,0 +1,91 @@
+"""
+Timing benchmark of building the machine learning data set from patient_data.csv
+Generates patient_ids.csv, data_codes.csv and patient_data.csv for 100k patients x 7 data codes in a temporary
+directory, 20% of the values being "No Data", then times MachineLearningClient.set_data_values_array and the
+whole data set with its CSV file (export_data_set_csv, get_data_values_array in older versions).
+Run it against another checkout to compare two versions:
+    python benchmarks/data_set_benchmark.py [path of the repository] [number of patients]
+"""
+import csv
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+REPEATS = 3
+DATA_CODES = [("55284-4", "Systolic Blood Pressure"), ("2339-0", "Glucose"),
+              ("72166-2", "Tobacco smoking status NHIS"), ("39156-5", "Body Mass Index"), ("2947-0", "Sodium"),
+              ("29463-7", "Body Weight"), ("2093-3", "Total Cholesterol")]
+NO_DATA_FRACTION = 0.2
+
+
+def write_input_files(directory, patient_count, seed=100):
+    """
+    Write the CSV files read by get_data_values_array in the "Machine Learning Data" folder of the directory
+    :param directory: directory the benchmark runs in
+    :param patient_count: number of patients
+    :param seed: seed of the random values
+    :return: None
+    """
+    data_directory = os.path.join(directory, "Machine Learning Data")
+    os.makedirs(data_directory)
+    patient_ids = [str(1000 + i) for i in range(patient_count)]
+    random.seed(seed)
+
+    with open(os.path.join(data_directory, "patient_ids.csv"), "w", newline="") as patient_id_file:
+        file_writer = csv.writer(patient_id_file)
+        file_writer.writerow(["PATIENT ID"])
+        file_writer.writerows([patient_id] for patient_id in patient_ids)
+
+    with open(os.path.join(data_directory, "data_codes.csv"), "w", newline="") as data_code_file:
+        file_writer = csv.writer(data_code_file)
+        file_writer.writerow(["DATA CODES"])
+        file_writer.writerows([data_code] for data_code, _ in DATA_CODES)
+
+    # VALUE is the third column, where the versions before the DATA CODE column read it
+    with open(os.path.join(data_directory, "patient_data.csv"), "w", newline="") as patient_data_file:
+        file_writer = csv.writer(patient_data_file)
+        file_writer.writerow(["PATIENT ID", "DIAGNOSTIC DESCRIPTION", "VALUE", "DATA CODE"])
+        for patient_id in patient_ids:
+            for data_code, description in DATA_CODES:
+                if random.random() < NO_DATA_FRACTION:
+                    file_writer.writerow([patient_id, "No Data", "No Data", data_code])
+                else:
+                    file_writer.writerow([patient_id, description, round(random.uniform(1, 300), 2), data_code])
+
+
+def main(repository, patient_count):
+    sys.path.insert(0, os.path.abspath(repository))
+    from src.machine_learning_module import MachineLearningClient
+
+    print("Repository: " + os.path.abspath(repository))
+    client = MachineLearningClient("http://localhost")
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        write_input_files(directory, patient_count)
+        print(f"{patient_count} patients x {len(DATA_CODES)} data codes, "
+              f"{os.path.getsize(os.path.join(directory, 'Machine Learning Data', 'patient_data.csv')) / 1e6:.1f} MB")
+
+        # The module reads and writes its files relative to the working directory
+        os.chdir(directory)
+        try:
+            # Reading and pivoting patient_data.csv, then the whole data set including writing its CSV file, which
+            # older versions always write
+            build_data_set = getattr(client, "export_data_set_csv", client.get_data_values_array)
+            for function in [client.set_data_values_array, build_data_set]:
+                times = []
+                for _ in range(REPEATS):
+                    start = time.perf_counter()
+                    function()
+                    times.append(time.perf_counter() - start)
+                print(f"{function.__name__:22} median {statistics.median(times):.2f} s, "
+                      f"min {min(times):.2f} s, max {max(times):.2f} s")
+        finally:
+            os.chdir(working_directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), ".."),
+         int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
@@ -0,0 +1,169 @@
+"""
+Login benchmark of FHIRClient.get_patient_list against a stub FHIR server
+The stub answers in-process, after a fixed latency per request, for a practitioner with 300 patients and 1200
+encounters in pages of 50. Patients are included in the encounter pages when the search asks for them with the
+valid _include=Encounter:patient, like the real server. The time of a login and the requests it sent are reported
+for each worker count the client supports.
+Run it against another checkout to compare two versions:
+    python benchmarks/login_benchmark.py [path of the repository] [latency in ms]
+"""
+import contextlib
+import inspect
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+REPEATS = 3
+PATIENT_COUNT = 300
+ENCOUNTERS_PER_PATIENT = 4
+PAGE_SIZE = 50
+ROOT_URL = "http://stub.fhir/fhir/"
+PRACTITIONER_ID = 500
+
+
+class StubResponse:
+    def __init__(self, data):
+        self._text = json.dumps(data)
+        self.status_code = 200
+        self.headers = {}
+
+    @property
+    def text(self):
+        return self._text
+
+    def json(self):
+        return json.loads(self._text)
+
+    def raise_for_status(self):
+        pass
+
+
+class StubTransport:
+    """
+    Answers the Encounter searches and Patient reads of a login, after sleeping for the latency of a request
+    Sleeping releases the GIL, so requests sent at the same time wait in parallel like on a real server
+    """
+
+    def __init__(self, latency, seed=100):
+        """
+        :param latency: seconds each request takes
+        :param seed: seed of the order of the encounters
+        """
+        self._latency = latency
+        self._lock = threading.Lock()
+        self.requests = {}  # kind of request -> number sent
+        self._patients = {str(1000 + i): make_patient(1000 + i) for i in range(PATIENT_COUNT)}
+        encounters = [patient_id for patient_id in self._patients for _ in range(ENCOUNTERS_PER_PATIENT)]
+        random.Random(seed).shuffle(encounters)
+        self._encounters = [{"resourceType": "Encounter", "id": "e" + str(i),
+                             "subject": {"reference": "Patient/" + patient_id}}
+                            for i, patient_id in enumerate(encounters)]
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+
+    def get(self, url, **kwargs):
+        time.sleep(self._latency)
+        parsed_url = urlparse(url)
+        path = parsed_url.path[len(urlparse(ROOT_URL).path):]
+        query = parse_qs(parsed_url.query)
+
+        if path.startswith("Patient/"):
+            self._count("Patient read")
+            return StubResponse(self._patients[path.split("/")[1]])
+
+        if path == "Encounter":
+            self._count("Encounter page")
+            page = int(query.get("_page", ["0"])[0])
+            encounters = self._encounters[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+            entries = [{"resource": encounter, "search": {"mode": "match"}} for encounter in encounters]
+            if "Encounter:patient" in query.get("_include", []):
+                included = dict.fromkeys(encounter["subject"]["reference"].split("/")[1] for encounter in encounters)
+                entries += [{"resource": self._patients[patient_id], "search": {"mode": "include"}}
+                            for patient_id in included]
+            links = [{"relation": "self", "url": url}]
+            if (page + 1) * PAGE_SIZE < len(self._encounters):
+                next_query = "&".join(key + "=" + value for key, values in query.items() if key != "_page"
+                                      for value in values)
+                links.append({"relation": "next", "url": ROOT_URL + "Encounter?" + next_query +
+                              "&_page=" + str(page + 1)})
+            return StubResponse({"resourceType": "Bundle", "type": "searchset", "link": links, "entry": entries})
+
+        raise ValueError("The stub server does not answer " + url)
+
+    def _count(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+
+def make_patient(number):
+    """
+    :param number: number of the patient
+    :return: FHIR Patient resource
+    """
+    # The client drops the digits of names, so each patient gets a distinct name made of letters
+    letters = "".join(chr(ord("a") + int(digit)) for digit in str(number))
+    return {"resourceType": "Patient", "id": str(number),
+            "name": [{"use": "official", "given": ["Given" + letters], "family": "Family" + letters}],
+            "gender": "male" if number % 2 == 0 else "female",
+            "birthDate": "19" + str(50 + number % 50) + "-01-01",
+            "address": [{"line": [str(number) + " Example Street"], "city": "Melbourne", "state": "VIC",
+                         "country": "AU"}]}
+
+
+def make_client(client_class, transport, max_workers):
+    """
+    Create a client sending its requests to the stub, through its transport or, for versions without one, by
+    replacing requests.get
+    :return: tuple of (client, context manager to use while the client runs)
+    """
+    parameters = inspect.signature(client_class.__init__).parameters
+    kwargs = {}
+    if "max_workers" in parameters:
+        kwargs["max_workers"] = max_workers
+    if "transport" in parameters:
+        return client_class(ROOT_URL, transport=transport, **kwargs), contextlib.nullcontext()
+    from src import fhir_module
+    return client_class(ROOT_URL, **kwargs), mock.patch.object(fhir_module.requests, "get", transport.get)
+
+
+def main(repository, latency):
+    sys.path.insert(0, os.path.abspath(repository))
+    from src.fhir_module import FHIRClient, CholesterolDataClient
+
+    print("Repository: " + os.path.abspath(repository))
+    print(f"{PATIENT_COUNT} patients, {PATIENT_COUNT * ENCOUNTERS_PER_PATIENT} encounters, "
+          f"{latency * 1000:.0f} ms per request")
+    transport = StubTransport(latency)
+    worker_counts = [1, 8] if "max_workers" in inspect.signature(FHIRClient.__init__).parameters else [None]
+
+    patient_ids = None
+    for max_workers in worker_counts:
+        client, patch = make_client(CholesterolDataClient, transport, max_workers)
+        times = []
+        with patch:
+            for _ in range(REPEATS):
+                transport.reset()
+                start = time.perf_counter()
+                patient_list = client.get_patient_list(PRACTITIONER_ID)
+                times.append(time.perf_counter() - start)
+
+        # Every version must return the same patients in the same order
+        ids = [patient.id for patient in patient_list.get_patient_list()]
+        assert patient_ids is None or ids == patient_ids
+        patient_ids = ids
+        requests = ", ".join(f"{count} {kind}s" for kind, count in sorted(transport.requests.items()))
+        workers = "" if max_workers is None else f"max_workers={max_workers}  "
+        print(f"{workers}login median {statistics.median(times):.2f} s, {len(ids)} patients, {requests}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), ".."),
+         float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02)
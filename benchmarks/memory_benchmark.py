@@ -0,0 +1,134 @@
+"""
+Memory and pickling benchmark of the patients held by the application
+Builds 10k patients, each with 1 cholesterol and 5 blood pressure observations, from FHIR resources the way
+fhir_module does. Memory is measured with tracemalloc, pickling times are the median of several runs.
+Run it against another checkout to compare two versions:
+    python benchmarks/memory_benchmark.py [path of the repository] [number of patients]
+"""
+import gc
+import json
+import os
+import pickle
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+REPEATS = 3
+CITIES = ["Melbourne", "Sydney", "Brisbane", "Perth", "Adelaide"]
+
+
+def make_patient_resource(i):
+    """
+    :param i: index of the patient
+    :return: JSON text of a FHIR Patient resource
+    """
+    return json.dumps({
+        "resourceType": "Patient",
+        "id": str(100000 + i),
+        "name": [{"use": "official", "given": ["Given" + str(i)], "family": "Family" + str(i)}],
+        "gender": "male" if i % 2 == 0 else "female",
+        "birthDate": (datetime(1950, 1, 1) + timedelta(days=i % 20000)).strftime("%Y-%m-%d"),
+        "address": [{"line": [str(i) + " Example Street"], "city": CITIES[i % len(CITIES)], "state": "VIC",
+                     "country": "AU"}],
+    })
+
+
+def make_observation_resources(i):
+    """
+    :param i: index of the patient
+    :return: JSON text of the patient's cholesterol observations and of their blood pressure observations
+    """
+    start = datetime(2019, 1, 1) + timedelta(hours=i)
+    cholesterol = [{
+        "valueQuantity": {"value": 150 + i % 100 + 0.5, "unit": "mg/dL"},
+        "effectiveDateTime": start.isoformat() + "+10:00",
+    }]
+    blood_pressure = []
+    for j in range(5):
+        blood_pressure.append({
+            "component": [
+                {"code": {"coding": [{"code": "8480-6"}]}, "valueQuantity": {"value": 110 + (i + j) % 40,
+                                                                             "unit": "mm[Hg]"}},
+                {"code": {"coding": [{"code": "8462-4"}]}, "valueQuantity": {"value": 70 + (i + j) % 20,
+                                                                             "unit": "mm[Hg]"}},
+            ],
+            "effectiveDateTime": (start - timedelta(days=30 * j)).isoformat() + "+10:00",
+        })
+    return json.dumps(cholesterol), json.dumps(blood_pressure)
+
+
+def build_patients(resources):
+    """
+    Parse the resources into patients, strings are decoded from JSON so nothing is shared by accident
+    :param resources: list of (patient JSON, cholesterol JSON, blood pressure JSON)
+    :return: list of Patient objects
+    """
+    from src.fhir_module import FHIRClient, CholesterolDataClient, BloodPressureDataClient
+
+    patients = []
+    for patient_text, cholesterol_text, blood_pressure_text in resources:
+        patient = FHIRClient.parse_patient(json.loads(patient_text))
+        patient.update_data((CholesterolDataClient.parse_patient_data(json.loads(cholesterol_text)),
+                             BloodPressureDataClient.parse_patient_data(json.loads(blood_pressure_text))))
+        patients.append(patient)
+    return patients
+
+
+def time_median(function):
+    """
+    :param function: function called without arguments
+    :return: median time in seconds of REPEATS calls
+    """
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(repository, patient_count):
+    sys.path.insert(0, os.path.abspath(repository))
+    from src import person_module
+
+    print("Repository: " + os.path.abspath(repository))
+    resources = [(make_patient_resource(i),) + make_observation_resources(i) for i in range(patient_count)]
+
+    # Import everything and warm up the caches before measuring
+    build_patients(resources[:10])
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    patients = build_patients(resources)
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"memory   {memory / 1e6:.1f} MB for {patient_count} patients ({memory / patient_count:.0f} B/patient)")
+
+    pickled = pickle.dumps(patients)
+    print(f"pickle   {len(pickled) / 1e6:.1f} MB, "
+          f"dumps {time_median(lambda: pickle.dumps(patients)) * 1000:.0f} ms, "
+          f"loads {time_median(lambda: pickle.loads(pickled)) * 1000:.0f} ms")
+
+    # Observation data objects on their own, as returned by the FHIR clients
+    from src.fhir_module import BloodPressureDataClient
+    blood_pressure_texts = [resource[2] for resource in resources]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    blood_pressure_data = [BloodPressureDataClient.parse_patient_data(json.loads(text))
+                           for text in blood_pressure_texts]
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    count = sum(len(data) for data in blood_pressure_data)
+    print(f"{count} standalone BloodPressureData objects: {memory / 1e6:.1f} MB")
+
+    assert isinstance(patients[0], person_module.Patient)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), ".."),
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
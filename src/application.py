@@ -1,96 +1,198 @@
+from abc import ABC, abstractmethod
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
 from src.fhir_module import *
+from src.scheduler_module import RefreshScheduler, AdaptivePollingPolicy
+from src.storage_module import PractitionerStore
+from src.event_module import CoalescingQueue, Observer, CHOLESTEROL, BLOOD_PRESSURE
+from src.graph_module import CholesterolGraph, BloodPressureGraph, SystolicHistoryGraph
+from src.highlight_module import RowHighlighter, classify_cholesterol, classify_blood_pressure, \
+    CHOLESTEROL_COLOURS, BLOOD_PRESSURE_COLOURS
 from PIL import ImageTk, Image
-import pickle
-import time
+import functools
 import threading
+import requests
 import matplotlib
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from abc import ABC, abstractmethod
 matplotlib.use("TkAgg")
 
 
-class Observer(ABC):
-    def set_subject(self, subject):
-        self._subject = subject
+class PatientTreeview(ttk.Treeview, ABC):
+    """
+    Table whose rows each display one patient
+    The item of every patient's row is kept in a map, so rows are found, updated and deleted without scanning the
+    table. The data displayed in each row is remembered, so a row is only written when its data changed
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._items = {}  # patient id -> item, items are created with the patient's id
+        self._patient_ids = {}  # item -> patient id
+        self._shown_data = {}  # patient id -> data displayed in the row
 
     @abstractmethod
-    def update(self):
+    def format_row(self, patient):
+        """
+        :param patient: Patient object
+        :return: values displayed in the patient's row
+        """
         pass
 
+    @abstractmethod
+    def get_row_data(self, patient):
+        """
+        :param patient: Patient object
+        :return: typed data displayed in the patient's row, compared to find out whether the row must be written
+        """
+        pass
 
-class GraphicalMonitor(Observer, Figure):
+    def has_patient(self, patient_id):
+        return patient_id in self._items
 
-    def update(self):
-        if self._subject is not None:  # If subject has not been specified, do nothing
-            self.show()
+    def get_item(self, patient_id):
+        """
+        :param patient_id: patient's id
+        :return: item of the patient's row, None if the patient is not displayed
+        """
+        return self._items.get(patient_id)
+
+    def get_patient_id(self, item):
+        """
+        :param item: item of a row
+        :return: id of the patient displayed in the row, None if the item is not a patient's row
+        """
+        return self._patient_ids.get(item)
+
+    def get_patient_items(self):
+        """
+        :return: dictionary of patient id -> item for every displayed patient, in display order
+        """
+        return self._items
+
+    def show_patient(self, patient):
+        """
+        Add a row for the patient, or update their row if they are already displayed
+        :param patient: Patient object
+        :return: True if the row was written, False if it already displayed the patient's data
+        """
+        item = self._items.get(patient.id)
+        row_data = self.get_row_data(patient)
+        if item is None:
+            item = self.insert("", "end", iid=patient.id, values=self.format_row(patient))
+            self._items[patient.id] = item
+            self._patient_ids[item] = patient.id
+        elif self._shown_data.get(patient.id) == row_data:
+            return False
+        else:
+            self.item(item, values=self.format_row(patient))
+        self._shown_data[patient.id] = row_data
+        return True
+
+    def show_patients(self, patients):
+        """
+        Display exactly the given patients in one pass, rows of other patients are deleted
+        :param patients: list of Patient objects
+        :return: None
+        """
+        patient_ids = set(patient.id for patient in patients)
+        deleted_items = []
+        for patient_id in [patient_id for patient_id in self._items if patient_id not in patient_ids]:
+            item = self._items.pop(patient_id)
+            del self._patient_ids[item]
+            self._shown_data.pop(patient_id, None)
+            deleted_items.append(item)
+        if len(deleted_items) > 0:
+            self.delete(*deleted_items)
+        for patient in patients:
+            self.show_patient(patient)
+
+    def delete_patient(self, patient_id):
+        """
+        Delete the patient's row
+        :param patient_id: patient's id
+        :return: None
+        """
+        item = self._items.pop(patient_id, None)
+        if item is not None:
+            del self._patient_ids[item]
+            self._shown_data.pop(patient_id, None)
+            self.delete(item)
 
+    def clear(self):
+        """
+        Delete every row
+        :return: None
+        """
+        if len(self._items) > 0:
+            self.delete(*self._items.values())
+        self._items.clear()
+        self._patient_ids.clear()
+        self._shown_data.clear()
 
-class CholesterolMonitor(Observer, ttk.Treeview):
+
+class PatientMonitor(Observer, PatientTreeview):
     """
-    This class is the table which displays all of the patients being monitored and their data
-    It observes the monitored patient list and update its display accordingly
+    Table of monitored patients which observes the monitored patient list and updates its rows accordingly
     """
 
-    def update(self):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._subject = None
+
+    def update(self, changes):
         """
-        Update the view according to the Patient List object being observed
+        Update the rows of the patients whose data changed in the Patient List object being observed
+        :param changes: dictionary of patient id -> set of the kinds of change to the patient
         :return: None
         """
         if self._subject is not None:  # If subject has not been specified, do nothing
-            children = self.get_children('')
-            for item in children:
-                values = self.item(item, "values")
-                patient_name = values[0]
-                current_patient = self._subject.select_patient(patient_name)
-                if is_new_cholesterol_data(values, current_patient):  # Check if the new values are different
-                    self.item(item, values=format_data(current_patient)[:3])  # update the display with new data
+            for patient_id in changes:
+                if self.has_patient(patient_id):
+                    current_patient = self._subject.get_patient(patient_id)
+                    if current_patient is not None:
+                        self.show_patient(current_patient)  # only written if the data is different
 
 
-class BloodPressureMonitor(Observer, ttk.Treeview):
+class CholesterolMonitor(PatientMonitor):
     """
     This class is the table which displays all of the patients being monitored and their data
     It observes the monitored patient list and update its display accordingly
     """
+    changes = {CHOLESTEROL}
 
-    def update(self):
-        """
-        Update the view according to the Patient List object being observed
-        :return: None
-        """
-        if self._subject is not None:  # If subject has not been specified, do nothing
-            children = self.get_children('')
-            for item in children:
-                values = self.item(item, "values")
-                patient_name = values[0]
-                current_patient = self._subject.select_patient(patient_name)
-                if is_new_blood_pressure_data(values, current_patient):  # Check if the new values are different
-                    self.item(item, values=format_data(current_patient)[3:])  # update the display with new data
+    def format_row(self, patient):
+        return format_data(patient)[:3]
 
+    def get_row_data(self, patient):
+        return get_cholesterol_state(patient)
 
-class HistoricalSystolicMonitor(Observer, ttk.Treeview):
+
+class BloodPressureMonitor(PatientMonitor):
+    """
+    This class is the table which displays all of the patients being monitored and their data
+    It observes the monitored patient list and update its display accordingly
+    """
+    changes = {BLOOD_PRESSURE}
+
+    def format_row(self, patient):
+        return format_data(patient)[3:]
+
+    def get_row_data(self, patient):
+        return get_blood_pressure_state(patient)
+
+
+class HistoricalSystolicMonitor(PatientMonitor):
     """
     This class is a table which displays the latest 5 systolic blood pressure observations for all patients with
     a high systolic blood pressure level
     """
+    changes = {BLOOD_PRESSURE}
 
-    def update(self):
-        """
-        Update the table according to the Patient List object being observed
-        :return: None
-        """
-        if self._subject is not None:  # If subject has not been specified, do nothing
-            children = self.get_children('')
-            for item in children:
-                values = self.item(item, "values")
-                patient_name = values[0]
-                current_patient = self._subject.select_patient(patient_name)
-                new_data = format_historical_systolic_data(current_patient)
-                if new_data != values:  # Check if the new values are different
-                    self.item(item, values=new_data)  # update the display with new data
+    def format_row(self, patient):
+        return format_historical_systolic_data(patient)
+
+    def get_row_data(self, patient):
+        return get_systolic_history_state(patient)
 
 
 class App:
@@ -102,7 +204,13 @@ class App:
         self.practitioner = None
         self.cholesterol_client = None
         self.blood_pressure_client = None
+        self.combined_client = None
+        self.store = None
+        self.updates = CoalescingQueue()  # changes found by worker threads, applied on the Tk thread
+        self.update_period = 100  # milliseconds between two applications of the changes
         self.update_interval = 5
+        self.update_intervals = {"Cholesterol": 5, "Blood Pressure": 5}  # seconds between requests per data type
+        self.scheduler = RefreshScheduler()
         self.systolic_limit = '125'
         self.diastolic_limit = '80'
         self.main_UI = None
@@ -119,6 +227,8 @@ class App:
         self.diastolic_limit_field = None
         self.diastolic_limit_label = None
         self.blood_pressure_monitor = None
+        self.cholesterol_highlighter = None
+        self.blood_pressure_highlighter = None
         self.cholesterol_graphical_monitor = None
         self.BP_graphical_monitor = None
         self.selected_monitor_option = None
@@ -130,6 +240,12 @@ class App:
     def set_blood_pressure_client(self, client):
         self.blood_pressure_client = client
 
+    def set_combined_client(self, client):
+        self.combined_client = client
+
+    def set_store(self, store):
+        self.store = store
+
     def set_practitioner(self, practitioner):
         self.practitioner = practitioner
 
@@ -207,6 +323,10 @@ class App:
         self.blood_pressure_monitor.grid(row=2, column=4, columnspan=4)
         self.blood_pressure_monitor.bind("<Delete>", self.remove_monitored_patient)
 
+        # Highlighting of the monitors' rows
+        self.cholesterol_highlighter = RowHighlighter(self.cholesterol_monitor, CHOLESTEROL_COLOURS)
+        self.blood_pressure_highlighter = RowHighlighter(self.blood_pressure_monitor, BLOOD_PRESSURE_COLOURS)
+
         # create buttons
         add_patient_button = tk.Button(self.main_UI, text="Add Monitor", width=15, command=self.add_monitored_patient)
         add_patient_button.grid(row=4, column=0)
@@ -238,7 +358,8 @@ class App:
     def practitioner_login(self, event=None):
         """
         Retrieve and display the list of all patients of the practitioner with the given identifier
-        First try to load data from local storage, if not found, request from server
+        The patients found in local storage are displayed straight away, the list is then reconciled with the server
+        in the background and the rows which changed are updated as their data arrives
         """
 
         # Get practitioner id from entry field
@@ -247,23 +368,11 @@ class App:
         try:
             if practitioner_id == "":  # if no identifier specified
                 raise KeyError
-            try:
-                # Try to get load data from local storage
-                filename = "Practitioner Data/" + practitioner_id
-                file = open(filename, 'rb')
-                current_practitioner = pickle.load(file)
-                file.close()
-            except FileNotFoundError:
+            # Try to get load data from local storage
+            current_practitioner = self.store.load_practitioner(practitioner_id)
+            if current_practitioner is None:
                 print("No data found in storage, requesting from server...")
                 current_practitioner = self.cholesterol_client.get_practitioner_info(practitioner_id)
-                current_practitioner.get_patient_list(self.cholesterol_client)
-
-                # Retrieve and update patient data from the server
-                for patient in current_practitioner.get_all_patients().get_patient_list():
-                    cholesterol_data = self.cholesterol_client.get_patient_data(patient.id)
-                    blood_pressure_data = self.blood_pressure_client.get_patient_data(patient.id)
-                    patient.update_data(cholesterol_data)
-                    patient.update_data(blood_pressure_data)
 
             # Updating the UI with the practitioner's name and time interval input
             self.entry_field.destroy()
@@ -313,17 +422,23 @@ class App:
             # Get the practitioner's patient list
             patient_list = current_practitioner.get_all_patients()
 
-            # display patient list
+            # display patient list, rows are identified by patient id
             for patient in patient_list.get_patient_list():
                 # Insert into treeview if the patient does not already exist
-                if not duplicate_item(self.all_patients, format_data(patient)):
-                    self.all_patients.insert("", "end", values=format_data(patient))
+                if not self.all_patients.exists(patient.id):
+                    self.all_patients.insert("", "end", iid=patient.id, values=format_data(patient))
 
-            # Start a separate thread to update the patient's data concurrently
+            # Reconcile the stored patient list with the server in the background
             self.set_practitioner(current_practitioner)
-            subthread = threading.Thread(target=self.request_patient_data)
-            subthread.setDaemon(True)
-            subthread.start()
+            reconcile_thread = threading.Thread(target=self.reconcile_patients, args=(current_practitioner,),
+                                                daemon=True)
+            reconcile_thread.start()
+            self.main_UI.after(self.update_period, self.process_updates)
+
+            # Request the patient's data in the background, rescheduled whenever the monitor option changes
+            self.selected_monitor_option.trace_add("write", self.schedule_refresh)
+            self.scheduler.start()
+            self.schedule_refresh()
 
             # Attach monitored patient list to treeview observer
             self.practitioner.get_monitored_patients().attach(self.cholesterol_monitor)
@@ -332,13 +447,121 @@ class App:
         except KeyError:
             messagebox.showinfo("Error", "Invalid practitioner identifier")
 
+    def reconcile_patients(self, practitioner):
+        """
+        Request the practitioner's patient list and every patient's data from the server, run on a worker thread
+        The changes are put on the updates queue as they arrive, so the displayed list is updated in steps
+        :param practitioner: HealthPractitioner whose patient list is displayed
+        """
+        try:
+            stored_patients = {}
+            for patient in practitioner.get_all_patients().get_patient_list():
+                stored_patients[str(patient.id)] = patient
+
+            # Match the stored patients with the server's patient list
+            patients = []
+            server_patients = self.cholesterol_client.get_patient_list(practitioner.id).get_patient_list()
+            for server_patient in server_patients:
+                patient = stored_patients.pop(str(server_patient.id), None)
+                if patient is not None:
+                    server_patient.release_row()  # only the stored patient is kept
+                else:
+                    # New patient, displayed without data until it arrives
+                    patient = server_patient
+                    patient.update_data(CholesterolData("-", "", "-"))
+                    patient.update_data([BloodPressureData("-", "-", "", "-")])
+                    self.updates.put(("add", patient.id), ("add", patient, None))
+                patients.append(patient)
+            for patient in stored_patients.values():
+                self.updates.put(("remove", patient.id), ("remove", patient, None))
+
+            # Request the data of every patient, each batch is displayed as soon as it arrives
+            patient_ids = [patient.id for patient in patients]
+            patients_by_id = {str(patient.id): patient for patient in patients}
+            if self.combined_client is not None:
+                clients = [self.combined_client]
+            else:
+                clients = [self.cholesterol_client, self.blood_pressure_client]
+            for client in clients:
+                for batch_data in client.iter_patients_data(patient_ids):
+                    for patient_id, patient_data in batch_data.items():
+                        self.put_patient_update(patients_by_id[patient_id], patient_data)
+
+        except requests.RequestException as error:
+            print("Could not reconcile the patient list with the server: " + str(error))
+        except KeyError:
+            print("Could not reconcile the patient list with the server: unexpected response")
+
+    def put_patient_update(self, patient, patient_data):
+        """
+        Queue new data of a patient to be applied on the Tk thread, run on worker threads
+        Data of the same type received again for the patient before it is applied replaces the older data
+        :param patient: Patient object
+        :param patient_data: patient data object(s) returned by a FHIR Client
+        :return: None
+        """
+        self.updates.put(("update", patient.id, type(patient_data).__name__), ("update", patient, patient_data))
+
+    def process_updates(self):
+        """
+        Apply the changes queued by the worker threads, run on the Tk thread every update period
+        Changes to the same patient are applied to the model first, so each changed row is written only once
+        """
+        patient_list = self.practitioner.get_all_patients()
+        monitored_patients = self.practitioner.get_monitored_patients()
+        changed_patients = {}  # patient id -> patient whose displayed data changed
+        for action, patient, patient_data in self.updates.drain():
+            if action == "add":
+                if patient not in patient_list:
+                    patient_list.add_patient(patient)
+                    self.all_patients.insert("", "end", iid=patient.id, values=format_data(patient))
+            elif action == "remove":
+                self.practitioner.remove_patient(patient.id)
+                if self.all_patients.exists(patient.id):
+                    self.all_patients.delete(patient.id)
+                self.cholesterol_monitor.delete_patient(patient.id)
+                self.blood_pressure_monitor.delete_patient(patient.id)
+                changed_patients.pop(patient.id, None)
+            elif action == "update":
+                # Data requested before the patient was removed is dropped, their row was released
+                if patient not in patient_list:
+                    continue
+                if len(self.practitioner.update_patient_data(patient, patient_data)) > 0:
+                    changed_patients[patient.id] = patient
+
+        for patient_id, patient in changed_patients.items():
+            if self.all_patients.exists(patient_id):
+                self.all_patients.item(patient_id, values=format_data(patient))
+
+        # Send the changes to the monitored patients' observers at once
+        if monitored_patients.has_changes():
+            monitored_patients.notify()
+            self.highlight_patients()
+
+        self.main_UI.after(self.update_period, self.process_updates)
+
     def set_update_interval(self, event=None):
         """
         Set the update interval for requesting patient's data from the server
         """
         # get interval value from entry field
-        update_interval = int(self.time_entry_field.get())
+        try:
+            update_interval = int(self.time_entry_field.get())
+        except ValueError:
+            update_interval = 0
+        if update_interval <= 0:
+            messagebox.showinfo("Error", "The update interval must be a whole number of seconds greater than 0")
+            return
         self.update_interval = update_interval
+        for data_type in self.update_intervals:
+            self.update_intervals[data_type] = update_interval
+        for job in self.scheduler.get_jobs():
+            self.scheduler.set_interval(job, update_interval)
+
+        # Patients are never requested more often than the update interval
+        for client in (self.cholesterol_client, self.blood_pressure_client, self.combined_client):
+            if client is not None and client.get_polling_policy() is not None:
+                client.get_polling_policy().min_interval = update_interval
         self.time_entry_label.destroy()
         self.time_entry_label = tk.Label(self.main_UI, text="Current update interval: " +
                                                             str(self.update_interval))
@@ -346,50 +569,72 @@ class App:
 
     def exit_program(self):
         """
-        Close the program and persists current practitioner's data using pickle
+        Close the program and persists the changes to the current practitioner's data in local storage
         """
+        self.scheduler.stop()
         try:
             # Clear the practitioner's monitored patient list for next run
             self.practitioner.clear_monitor()
-            # Copy the practitioner object to a binary file
-            filename = "Practitioner Data/" + str(self.practitioner.id)
-            outfile = open(filename, 'wb')
-            pickle.dump(self.practitioner, outfile)
-            outfile.close()
+            # Write the changed rows to the database
+            self.store.save_practitioner(self.practitioner)
+            self.store.close()
             exit(0)
         except AttributeError:
             exit(0)
 
-    def request_patient_data(self):
+    def schedule_refresh(self, *args):
         """
-        Request new patient data from server depending on monitor type and update display every N seconds
+        Schedule the jobs requesting new patient data for the selected monitor option
+        The jobs of the previous option are cancelled: their requests in progress stop before the next batch, and the
+        batches already received are still applied.
+        Cholesterol and blood pressure are requested together when both are monitored at the same interval
         """
-        while True:
-            # Execute if there's at least one patient being monitored
-            if len(self.practitioner.get_monitored_patients()) > 0:
-
-                # Request data from server depending on monitor option
-                if self.selected_monitor_option.get() == "Cholesterol" or self.selected_monitor_option.get() == "Both":
-                    print("Requesting cholesterol data for " +
-                          str(len(self.practitioner.get_monitored_patients().get_patient_list())) + " patient(s)")
-                    self.practitioner.get_patient_data(self.cholesterol_client)
-                if self.selected_monitor_option.get() == "Blood Pressure" or self.selected_monitor_option.get() == "Both":
-                    print("Requesting blood pressure data for " +
-                          str(len(self.practitioner.get_monitored_patients().get_patient_list())) + " patient(s)")
-                    self.practitioner.get_patient_data(self.blood_pressure_client)
+        self.scheduler.cancel_all()
+        monitor_option = self.selected_monitor_option.get()
+
+        clients = {}
+        if monitor_option == "Both" and self.combined_client is not None and \
+                self.update_intervals["Cholesterol"] == self.update_intervals["Blood Pressure"]:
+            clients["Both"] = self.combined_client
+        else:
+            if monitor_option == "Cholesterol" or monitor_option == "Both":
+                clients["Cholesterol"] = self.cholesterol_client
+            if monitor_option == "Blood Pressure" or monitor_option == "Both":
+                clients["Blood Pressure"] = self.blood_pressure_client
+
+        for data_type, client in clients.items():
+            interval = self.update_intervals.get(data_type, self.update_intervals["Cholesterol"])
+            self.scheduler.schedule(data_type, interval, functools.partial(self.request_patient_data, data_type, client))
+
+    def request_patient_data(self, data_type, client, cancelled):
+        """
+        Request new patient data of one data type from the server, run by the scheduler on a worker thread
+        The data is queued and applied to the patients and the display by process_updates on the Tk thread
+        :param data_type: "Cholesterol", "Blood Pressure" or "Both"
+        :param client: FHIR Client for the data type
+        :param cancelled: threading.Event set when the job is cancelled, no further request is sent once it is set
+        """
+        # Nothing to do until at least one patient is monitored, or once the job was cancelled
+        if len(self.practitioner.get_monitored_patients()) == 0 or cancelled.is_set():
+            return
 
-                # Notify Treeview observer of data changes
-                try:
-                    self.practitioner.get_monitored_patients().notify()
-                except AttributeError:
-                    time.sleep(1)
+        if data_type == "Both":
+            description = "cholesterol and blood pressure"
+        else:
+            description = data_type.lower()
+        print("Requesting " + description + " data for " +
+              str(len(self.practitioner.get_monitored_patients().get_patient_list())) + " patient(s)")
 
-                self.highlight_patients()
-                self.cholesterol_graph_data()
-                self.blood_pressure_graph_data()
+        try:
+            patient_data = self.practitioner.request_patient_data(client, cancelled)
+        except requests.RequestException as error:
+            print("Could not request " + description + " data: " + str(error))
+            return
 
-                # Sleep
-                time.sleep(self.update_interval)
+        # The data of the batches requested before a cancellation is still queued: the client's watermark has
+        # already moved past it, so it would not be reported again. It is applied on the Tk thread
+        for patient, data in patient_data:
+            self.put_patient_update(patient, data)
 
     def add_monitored_patient(self, event=None):
         """
@@ -397,104 +642,68 @@ class App:
         also add the patient to the practitioner's monitored patients list object
         """
         selected = self.all_patients.selection()
-        values = None
-        for item in selected:
+        patient = None
+        for item in selected:  # rows of the list of all patients are identified by patient id
             try:
-                values = self.all_patients.item(item, "values")
-                if not duplicate_item(self.cholesterol_monitor, values[:3]) and \
-                        not duplicate_item(self.blood_pressure_monitor, values[3:]):
+                patient = self.practitioner.get_all_patients().get_patient(item)
+                if patient is None:
+                    continue
+                if not self.cholesterol_monitor.has_patient(patient.id) and \
+                        not self.blood_pressure_monitor.has_patient(patient.id):
 
                     # Add patient to treeview depending on monitor option
                     if self.selected_monitor_option.get() == "Cholesterol" or self.selected_monitor_option.get() == "Both":
-                        self.cholesterol_monitor.insert("", "end", values=values[:3])
+                        self.cholesterol_monitor.show_patient(patient)
                     if self.selected_monitor_option.get() == "Blood Pressure" or self.selected_monitor_option.get() == "Both":
-                        self.blood_pressure_monitor.insert("", "end", values=values[3:])
+                        self.blood_pressure_monitor.show_patient(patient)
 
                     # Add patient to practitioner's monitored patient list
-                    self.practitioner.add_patient_monitor(values[0])
+                    self.practitioner.add_patient_monitor(patient.id)
                     self.highlight_patients()
             except IndexError:
-                return
-            except ValueError:
-                print("No patient data for " + values[0])
+                print("No patient data for " + patient.first_name + " " + patient.last_name)
+
+    def get_selected_patient_ids(self):
+        """
+        :return: ids of the patients selected in the cholesterol monitor, or in the blood pressure monitor if no
+        patient is selected in the cholesterol monitor
+        """
+        # Prioritize selection from cholesterol monitor
+        monitor = self.cholesterol_monitor
+        selected = monitor.selection()
+        if len(selected) == 0:
+            # If no selection from cholesterol monitor, try blood pressure monitor
+            monitor = self.blood_pressure_monitor
+            selected = monitor.selection()
+        return [monitor.get_patient_id(item) for item in selected if monitor.get_patient_id(item) is not None]
 
     def remove_monitored_patient(self, event=None):
         """
         Remove a patient from the list of monitored patients
         also remove the patient to the practitioner's monitored patients list object
         """
-        try:
-
-            # Prioritize selection from cholesterol monitor
-            selected = self.cholesterol_monitor.selection()
-            if len(selected) == 0:
-                # If no selection from cholesterol monitor, try blood pressure monitor
-                selected = self.blood_pressure_monitor.selection()
-
-            # For each selected patients
-            for item in selected:
-
-                try:
-                    # Get the values from cholesterol monitor
-                    values = self.cholesterol_monitor.item(item, "values")
-
-                    # Remove item from practitioner's monitored patient list
-                    self.practitioner.remove_patient_monitor(values[0])
-
-                    # Remove item from Cholesterol monitor
-                    index = self.cholesterol_monitor.get_children().index(item)
-                    self.cholesterol_monitor.delete(item)
-
-                    # Remove the same item from BP monitor
-                    item = self.blood_pressure_monitor.get_children()[index]
-                    self.blood_pressure_monitor.delete(item)
-
-                except tk.TclError:
-                    # Get the values from BP monitor
-                    values = self.blood_pressure_monitor.item(item, "values")
-
-                    # Remove item from practitioner's monitored patient list
-                    self.practitioner.remove_patient_monitor(values[0])
+        # For each selected patients
+        for patient_id in self.get_selected_patient_ids():
+            # Remove item from practitioner's monitored patient list
+            self.practitioner.remove_patient_monitor(patient_id)
 
-                    # Remove item from BP monitor
-                    index = self.blood_pressure_monitor.get_children().index(item)
-                    self.blood_pressure_monitor.delete(item)
+            # Remove the patient's rows from both monitors
+            self.cholesterol_monitor.delete_patient(patient_id)
+            self.blood_pressure_monitor.delete_patient(patient_id)
 
-                    # Remove the same item from Cholesterol monitor
-                    item = self.cholesterol_monitor.get_children()[index]
-                    self.cholesterol_monitor.delete(item)
-
-            self.highlight_patients()
-        except IndexError:
-            return
+        self.highlight_patients()
 
     def display_patient_info(self, event=None):
         """
         Display the selected patient's personal info in a pop-up window
         """
-        # Prioritize selection from cholesterol monitor
-        selected_patients = self.cholesterol_monitor.selection()
-        if len(selected_patients) == 0:
-            # If no selection from cholesterol monitor, try blood pressure monitor
-            selected_patients = self.blood_pressure_monitor.selection()
-
         # For each selected patient
-        for item in selected_patients:
-            # Get the values from the cholesterol monitor
-            try:
-                values = self.cholesterol_monitor.item(item, "values")
-            except tk.TclError:
-                index = self.blood_pressure_monitor.get_children().index(item)
-                item = self.cholesterol_monitor.get_children()[index]
-                values = self.cholesterol_monitor.item(item, "values")
-
+        for patient_id in self.get_selected_patient_ids():
             # Select patient from the list
             try:
-                patient = self.practitioner.get_monitored_patients().select_patient(values[0])
+                patient = self.practitioner.get_monitored_patients().get_patient(patient_id)
             except AttributeError:
                 return
-            except IndexError:
-                return
             if patient is None:
                 return
 
@@ -519,164 +728,77 @@ class App:
         If the cholesterol level is higher than the average of all monitored patients, highlight this patient in red
 
         For the blood pressure monitor:
-        If the systolic level is higher than the limit, highlight this patient in yellow
+        If the systolic level is higher than the limit, highlight this patient in green
         If the diastolic level is higher than the limit, highlight this patient in blue
         If the both levels are higher than the limits, highlight this patient in purple
+
+        The classes are computed from the monitored patient list, only the rows whose class changed are written
         """
         try:
+            monitored_patients = self.practitioner.get_monitored_patients()
+
             # Cholesterol Monitor
-            children = self.cholesterol_monitor.get_children('')
-            for child in children:
-                values = self.cholesterol_monitor.item(child, "values")
-                patient_cholesterol = values[1].split(' ')[0]
-                try:
-                    if float(
-                            patient_cholesterol) > self.practitioner.get_monitored_patients().average_cholesterol_level:
-                        self.cholesterol_monitor.item(child, tags=['high cholesterol'])
-                    else:
-                        self.cholesterol_monitor.item(child, tags=['normal'])
-                    self.cholesterol_monitor.tag_configure('normal', foreground=None)
-                    self.cholesterol_monitor.tag_configure('high cholesterol', foreground='red')
-                except ValueError:
-                    continue
+            average_cholesterol_level = monitored_patients.average_cholesterol_level
+            item_classes = {}
+            for item, patient in self.get_monitor_patients(self.cholesterol_monitor).items():
+                item_classes[item] = classify_cholesterol(patient, average_cholesterol_level)
+            self.cholesterol_highlighter.highlight(item_classes)
 
             # Blood pressure monitor
-            children = self.blood_pressure_monitor.get_children('')
-            for child in children:
-                values = self.blood_pressure_monitor.item(child, "values")
-                patient_systolic_blood_pressure = values[1].split('mm')[0]
-                patient_diastolic_blood_pressure = values[2].split('mm')[0]
-                try:
-                    if float(patient_systolic_blood_pressure) > float(self.systolic_limit) and \
-                            float(patient_diastolic_blood_pressure) > float(self.diastolic_limit):
-                        self.blood_pressure_monitor.item(child, tags=['high blood pressure'])
-                    elif float(patient_systolic_blood_pressure) > float(self.systolic_limit):
-                        self.blood_pressure_monitor.item(child, tags=['high systolic pressure'])
-                    elif float(patient_diastolic_blood_pressure) > float(self.diastolic_limit):
-                        self.blood_pressure_monitor.item(child, tags=['high diastolic pressure'])
-                    else:
-                        self.blood_pressure_monitor.item(child, tags=['normal'])
-
-                    self.blood_pressure_monitor.tag_configure('normal', foreground=None)
-                    self.blood_pressure_monitor.tag_configure('high systolic pressure', foreground='green')
-                    self.blood_pressure_monitor.tag_configure('high diastolic pressure', foreground='blue')
-                    self.blood_pressure_monitor.tag_configure('high blood pressure', foreground='purple')
-                except ValueError:
-                    continue
+            systolic_limit = float(self.systolic_limit)
+            diastolic_limit = float(self.diastolic_limit)
+            item_classes = {}
+            for item, patient in self.get_monitor_patients(self.blood_pressure_monitor).items():
+                item_classes[item] = classify_blood_pressure(patient, systolic_limit, diastolic_limit)
+            self.blood_pressure_highlighter.highlight(item_classes)
 
         except tk.TclError:
             return
 
-    def cholesterol_graph_data(self, event=None):
+    def get_monitor_patients(self, monitor):
         """
-        Visually displays the monitored patients cholesterol levels in the form of a bar graph.
+        :param monitor: cholesterol or blood pressure monitor
+        :return: dictionary of item -> monitored patient displayed in the row
         """
-        try:
-            if self.practitioner is not None:
-                patients = []
-                patient_data = []
-                children = self.cholesterol_monitor.get_children('')
-                for child in children:
-                    values = self.cholesterol_monitor.item(child, "values")
-                    patient_cholesterol = values[1].split(' ')[0]
-                    if patient_cholesterol != "-":
-                        patient_data.append(float(patient_cholesterol))
-                        patient_name = values[0]
-                        patients.append(patient_name)
-                X = patients
-                Y = patient_data
-                return (X, Y)
-
-        except KeyError:
-            messagebox.showinfo("Error", "No practitioner identifier given")
+        monitored_patients = self.practitioner.get_monitored_patients()
+        patients = {}
+        for patient_id, item in monitor.get_patient_items().items():
+            patient = monitored_patients.get_patient(patient_id)
+            if patient is not None:
+                patients[item] = patient
+        return patients
 
     def cholesterol_graph(self, event=None):
+        """
+        Visually displays the monitored patients cholesterol levels in the form of a bar graph, kept up to date
+        with the monitored patient list
+        """
+        if self.practitioner is None:
+            messagebox.showinfo("Error", "No practitioner identifier given")
+            return
 
-        graph_data = self.cholesterol_graph_data()
-        self.cholesterol_graphical_monitor = GraphicalMonitor(figsize=(5, 5), dpi=100)
-        subplot = self.cholesterol_graphical_monitor.add_subplot(1, 1, 1)
-        bars = subplot.bar(graph_data[0], graph_data[1])
-        subplot.set_title("Patient Cholesterol Data")
-        subplot.set_xlabel("Patient Names")
-        subplot.set_ylabel("Cholesterol Values (mg/dL)")
+        self.cholesterol_graphical_monitor = CholesterolGraph(figsize=(5, 5), dpi=100)
         self.practitioner.get_monitored_patients().attach(self.cholesterol_graphical_monitor)
 
-        for bar in bars:
-            yval = bar.get_height()
-            subplot.text(bar.get_x(), yval + 1, yval)
-
         cholesterol_graph = tk.Toplevel()
         cholesterol_graph.title("Cholesterol Graph")
-        canvas = FigureCanvasTkAgg(self.cholesterol_graphical_monitor, master=cholesterol_graph)
-        canvas.get_tk_widget().grid()
+        self.cholesterol_graphical_monitor.show_in(cholesterol_graph)
 
-    def blood_pressure_graph_data(self, event=None):
+    def blood_pressure_graph(self, event=None):
         """
-        Visually displays the monitored patients blood pressure levels in the form of a line graph.
+        Visually displays the monitored patients blood pressure levels in the form of bar graphs, kept up to date
+        with the monitored patient list
         """
-        try:
-            if self.practitioner is not None:
-                patients = []
-                patient_systolic_data = []
-                patient_diastolic_data = []
-                children_blood_pressure = self.blood_pressure_monitor.get_children('')
-                children_cholesterol = self.cholesterol_monitor.get_children('')
-                for child in children_blood_pressure:
-                    values = self.blood_pressure_monitor.item(child, "values")
-                    patient_systolic_blood_pressure = values[1].split('m')[0]
-                    patient_diastolic_blood_pressure = values[2].split('m')[0]
-                    if patient_systolic_blood_pressure != "-" and patient_diastolic_blood_pressure != "-":
-                        patient_systolic_data.append(float(patient_systolic_blood_pressure))
-                        patient_diastolic_data.append(float(patient_diastolic_blood_pressure))
-
-                for child in children_cholesterol:
-                    values = self.cholesterol_monitor.item(child, "values")
-                    patient_cholesterol = values[1].split(' ')[0]
-                    patient_name = values[0]
-                    if patient_cholesterol != "-":
-                        patients.append(patient_name)
-
-                X = patients
-                Y1 = patient_systolic_data
-                Y2 = patient_diastolic_data
-                return (X, Y1, Y2)
-
-        except KeyError:
+        if self.practitioner is None:
             messagebox.showinfo("Error", "No practitioner identifier given")
+            return
 
-    def blood_pressure_graph(self, event=None):
+        self.BP_graphical_monitor = BloodPressureGraph(figsize=(10, 5), dpi=100)
+        self.practitioner.get_monitored_patients().attach(self.BP_graphical_monitor)
 
-        try:
-            graph_data = self.blood_pressure_graph_data()
-            self.BP_graphical_monitor = GraphicalMonitor(figsize=(10, 5), dpi=100)
-            subplot1 = self.BP_graphical_monitor.add_subplot(1, 2, 1)
-            bars1 = subplot1.bar(graph_data[0], graph_data[1])
-            subplot1.set_title("Patient Systolic Data")
-            subplot1.set_xlabel("Patient Names")
-            subplot1.set_ylabel("Systolic Blood Pressure Values (mmHg)")
-
-            subplot2 = self.BP_graphical_monitor.add_subplot(1, 2, 2)
-            bars2 = subplot2.bar(graph_data[0], graph_data[2])
-            subplot2.set_title("Patient Diastolic Data")
-            subplot2.set_xlabel("Patient Names")
-            subplot2.set_ylabel("Diastolic Blood Pressure Values (mmHg)")
-            self.practitioner.get_monitored_patients().attach(self.BP_graphical_monitor)
-
-            for bar1 in bars1:
-                yval1 = bar1.get_height()
-                subplot1.text(bar1.get_x(), yval1 + 1, yval1)
-
-            for bar2 in bars2:
-                yval2 = bar2.get_height()
-                subplot2.text(bar2.get_x(), yval2 + 1, yval2)
-
-            blood_pressure_graphs = tk.Toplevel()
-            blood_pressure_graphs.title("Blood Pressure Graphs")
-            canvas = FigureCanvasTkAgg(self.BP_graphical_monitor, master=blood_pressure_graphs)
-            canvas.get_tk_widget().grid()
-
-        except ValueError:
-            print("Can't compute this graph, as there is not enough data")
+        blood_pressure_graphs = tk.Toplevel()
+        blood_pressure_graphs.title("Blood Pressure Graphs")
+        self.BP_graphical_monitor.show_in(blood_pressure_graphs)
 
     def monitor_blood_pressure(self, event=None):
         """
@@ -697,82 +819,50 @@ class App:
                 patient_info.column(col, width=100)
         patient_info.grid(row=0, column=0)
 
-        for item in self.blood_pressure_monitor.get_children():  # For each patient
-            systolic_values = []
-            values = self.blood_pressure_monitor.item(item, "values")
-            systolic_value = values[1].split("m")[0]
-
-            # If systolic value is not nothing
-            if systolic_value != "-":
-                if float(systolic_value) < float(self.systolic_limit):
-                    continue  # Skip if systolic pressure does not exceed limit
-            else:
-                continue
-
+        for patient_id in self.blood_pressure_monitor.get_patient_items():  # For each patient
             try:
                 # Select patient from the list
-                patient = self.practitioner.get_monitored_patients().select_patient(values[0])
+                patient = self.practitioner.get_monitored_patients().get_patient(patient_id)
             except AttributeError:
                 return
-            except IndexError:
-                return
             if patient is None:
                 return
 
-            output = ""  # output string with latest observations and effective time
-            for i in range(5):  # get the latest 5 systolic observations
-                try:
-                    current_data = patient.get_blood_pressure_data(i)
-                    # append systolic value and effective date to output
-                    output += str(current_data[0]) + " (" + current_data[-1] + "), "
-                    systolic_values.append(current_data[0])
-                except IndexError:
-                    continue
-
-            if output == "- (-), ":
-                output = "No data"
+            # Skip if there is no systolic value or it does not exceed limit
+            systolic_value = patient.get_blood_pressure_value(0)[0]
+            if systolic_value is None or systolic_value < float(self.systolic_limit):
+                continue
 
             # Add new entry for the patient in the table
-            new_entry = (patient.first_name + " " + patient.last_name, output)
-            patient_info.insert("", "end", values=new_entry)
+            patient_info.show_patient(patient)
 
-            # Add to observer list
-            self.practitioner.get_monitored_patients().attach(patient_info)
+        # Add to observer list, until the window is closed
+        monitored_patients = self.practitioner.get_monitored_patients()
+        monitored_patients.attach(patient_info)
+        info_window.bind("<Destroy>",
+                         lambda event: monitored_patients.detach(patient_info) if event.widget is info_window else None,
+                         add="+")
 
         def monitored_blood_pressure_graph():
 
             for item in patient_info.selection():
-                values = patient_info.item(item, "values")
-                patient_name = values[0]
-                systolic_data = values[1]
-                if systolic_data != "No data":
-                    data = systolic_data.rstrip()
-                    data = data.split(", ")
-                    # data = systolic_data.split(", ")
-                    y_values = []
-                    for value in data:
-                        value = value.split(" ")[0]
-                        y_values.append(float(value))
-
-                    y_values.reverse()                  # gets the systolic values in chronological order
-                    x_values = []
-                    for i in range(len(y_values)):
-                        x_values.append(i + 1)
-                    X = x_values
-                    Y = y_values
-
-                    figure = GraphicalMonitor(figsize=(5, 5), dpi=100)
-                    subplot = figure.add_subplot(1, 1, 1)
-                    subplot.plot(X, Y)
-                    subplot.set_title(patient_name + "'s Systolic Blood Pressure Data")
-                    subplot.set_xlabel("Observations")
-                    subplot.set_ylabel("Systolic Blood Pressure Values (mmHg)")
+                patient = self.practitioner.get_monitored_patients().get_patient(patient_info.get_patient_id(item))
+                if patient is None:
+                    continue
+                patient_name = patient.first_name + " " + patient.last_name
+                y_values = []
+                if patient is not None:
+                    for i in range(5):  # the latest 5 systolic observations
+                        systolic_value = patient.get_blood_pressure_value(i)[0]
+                        if systolic_value is not None:
+                            y_values.append(systolic_value)
+                if len(y_values) > 0:
+                    figure = SystolicHistoryGraph(patient, figsize=(5, 5), dpi=100)
                     self.practitioner.get_monitored_patients().attach(figure)
 
                     systolic_graph = tk.Toplevel()
                     systolic_graph.title(patient_name + "'s Systolic Blood Pressure graph")
-                    canvas = FigureCanvasTkAgg(figure, master=systolic_graph)
-                    canvas.get_tk_widget().grid()
+                    figure.show_in(systolic_graph)
 
                 else:
                     print("Can't compute this graph")
@@ -782,79 +872,45 @@ class App:
 
     def update_monitor(self):
         """Updates the app's GUI display depending on the selected monitor type"""
-
-        # If the selected monitor option is Cholesterol only
-        if self.selected_monitor_option.get() == "Cholesterol":
-
-            # Delete existing blood pressure display
-            self.blood_pressure_monitor.delete(*self.blood_pressure_monitor.get_children())
-
-            # Build the cholesterol display based on the practitioner's monitored patient list
-            for patient in self.practitioner.get_monitored_patients().get_patient_list():
-                values = format_data(patient)
-                if not duplicate_item(self.cholesterol_monitor, values[:3]):
-                    self.cholesterol_monitor.insert("", "end", values=values[:3])
-
-        # If the selected monitor option is Blood Pressure only
-        if self.selected_monitor_option.get() == "Blood Pressure":
-
-            # Delete existing cholesterol display
-            self.cholesterol_monitor.delete(*self.cholesterol_monitor.get_children())
-
-            # Build the blood pressure display based on the practitioner's monitored patient list
-            for patient in self.practitioner.get_monitored_patients().get_patient_list():
-                values = format_data(patient)
-                if not duplicate_item(self.blood_pressure_monitor, values[3:]):
-                    self.blood_pressure_monitor.insert("", "end", values=values[3:])
-
-        # If the selected monitor option is both cholesterol and blood pressure
-        if self.selected_monitor_option.get() == "Both":
-
-            # Delete both existing monitors
-            self.cholesterol_monitor.delete(*self.cholesterol_monitor.get_children())
-            self.blood_pressure_monitor.delete(*self.blood_pressure_monitor.get_children())
-
-            # Rebuild the monitors based on the practitioner's monitored patient list
-            for patient in self.practitioner.get_monitored_patients().get_patient_list():
-                values = format_data(patient)
-                if not duplicate_item(self.cholesterol_monitor, values[:3]):
-                    self.cholesterol_monitor.insert("", "end", values=values[:3])
-                if not duplicate_item(self.blood_pressure_monitor, values[3:]):
-                    self.blood_pressure_monitor.insert("", "end", values=values[3:])
+        monitored_patients = self.practitioner.get_monitored_patients().get_patient_list()
+
+        # Build the displays based on the practitioner's monitored patient list, in one pass per monitor
+        if self.selected_monitor_option.get() == "Cholesterol" or self.selected_monitor_option.get() == "Both":
+            self.cholesterol_monitor.show_patients(monitored_patients)
+        else:
+            self.cholesterol_monitor.clear()
+        if self.selected_monitor_option.get() == "Blood Pressure" or self.selected_monitor_option.get() == "Both":
+            self.blood_pressure_monitor.show_patients(monitored_patients)
+        else:
+            self.blood_pressure_monitor.clear()
 
         # Highlight the abnormal values in each monitors
         self.highlight_patients()
 
 
-def is_new_cholesterol_data(values, patient):
+def get_cholesterol_state(patient):
+    """
+    :param patient: a patient object
+    :return: a tuple of (cholesterol value, effective date), None where there is no data
+    """
+    return patient.get_cholesterol_value(), patient.get_cholesterol_date()
+
+
+def get_blood_pressure_state(patient):
     """
-    Check whether the new patient cholesterol data is different to the current values
-    :param values: current cholesterol values being displayed by the app
-    :param patient: a patient object which contains new patient data
-    :return: True if data differs, False otherwise
+    :param patient: a patient object
+    :return: a tuple of (systolic value, diastolic value, effective date) of the latest observation,
+    None where there is no data
     """
-    patient_data = patient.get_cholesterol_data()
-    cholesterol_level = str(patient_data[0]) + " " + patient_data[1]
-    effective_time = patient_data[2]
-    if values[1] == cholesterol_level and values[2] == effective_time:
-        return False
-    return True
+    return patient.get_blood_pressure_value(0) + (patient.get_blood_pressure_date(0),)
 
 
-def is_new_blood_pressure_data(values, patient):
+def get_systolic_history_state(patient):
     """
-    Check whether the new patient blood pressure data is different to the current values
-    :param values: current blood pressure values being displayed by the app
-    :param patient: a patient object which contains new patient data
-    :return: True if data differs, False otherwise
+    :param patient: a patient object
+    :return: a tuple of (systolic value, effective date) of the latest 5 blood pressure observations
     """
-    patient_data = patient.get_blood_pressure_data(0)
-    systolic_level = str(patient_data[0]) + patient_data[2]
-    diastolic_level = str(patient_data[1]) + patient_data[2]
-    effective_time = patient_data[3]
-    if values[0] == systolic_level and values[1] == diastolic_level and values[2] == effective_time:
-        return False
-    return True
+    return tuple((patient.get_blood_pressure_value(i)[0], patient.get_blood_pressure_date(i)) for i in range(5))
 
 
 def format_data(patient):
@@ -903,21 +959,6 @@ def format_historical_systolic_data(patient):
     return patient.first_name + " " + patient.last_name, output
 
 
-def duplicate_item(tree, item):
-    """
-    Checks whether an item already exists in the Treeview
-    :param tree: tkinter Treeview
-    :param item: an item to be added
-    :return: True if item already in list of children, False otherwise
-    """
-    children = tree.get_children()
-    for child in children:
-        values = tree.item(child, "values")
-        if values == item:
-            return True
-    return False
-
-
 def fixed_map(option, style):
     # Fix for setting text colour for Tkinter 8.6.9
     # From: https://core.tcl.tk/tk/info/509cafafae
@@ -933,8 +974,20 @@ def fixed_map(option, style):
 
 if __name__ == '__main__':
     app = App()
-    cholesterol_client = CholesterolDataClient("https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/")
-    blood_pressure_client = BloodPressureDataClient("https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/")
+    transport = HTTPTransport(pool_size=16)
+    cholesterol_client = CholesterolDataClient("https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/",
+                                               transport=transport)
+    blood_pressure_client = BloodPressureDataClient("https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/",
+                                                    transport=transport)
+    combined_client = CombinedDataClient("https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/", transport=transport)
+
+    # Cholesterol is measured every few months, blood pressure more often. The learned cadence sets each patient's
+    # longest interval for gaps of up to about 14 months for cholesterol and 7 months for blood pressure
+    cholesterol_client.set_polling_policy(AdaptivePollingPolicy(min_interval=5, max_interval=3600))
+    blood_pressure_client.set_polling_policy(AdaptivePollingPolicy(min_interval=5, max_interval=1800))
+    combined_client.set_polling_policy(AdaptivePollingPolicy(min_interval=5, max_interval=1800))
     app.set_cholesterol_client(cholesterol_client)
     app.set_blood_pressure_client(blood_pressure_client)
+    app.set_combined_client(combined_client)
+    app.set_store(PractitionerStore("Practitioner Data/practitioners.db", legacy_directory="Practitioner Data"))
     app.run()
@@ -0,0 +1,58 @@
+import threading
+from abc import ABC, abstractmethod
+
+# Kinds of change to a patient reported to the observers of a patient list
+CHOLESTEROL = "cholesterol"  # the patient's cholesterol observation changed
+BLOOD_PRESSURE = "blood pressure"  # the patient's blood pressure observations changed
+MEMBERSHIP = "membership"  # the patient was added to or removed from the list
+DATA_CHANGES = frozenset((CHOLESTEROL, BLOOD_PRESSURE))
+
+
+class CoalescingQueue:
+    """
+    Queue of events passed from worker threads to the Tk thread
+    Events put under the same key before the queue is drained are coalesced: only the latest event is kept, in the
+    position of the first one, so a patient updated several times between two drains is only processed once
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}  # key -> latest event, in the order the keys were first put
+
+    def __len__(self):
+        with self._lock:
+            return len(self._events)
+
+    def put(self, key, event):
+        """
+        Add an event, replacing the pending event with the same key
+        :param key: hashable key identifying what the event is about
+        :param event: the event
+        :return: None
+        """
+        with self._lock:
+            self._events[key] = event
+
+    def drain(self):
+        """
+        Remove and return every pending event
+        :return: list of events, in the order their keys were first put
+        """
+        with self._lock:
+            events = list(self._events.values())
+            self._events.clear()
+        return events
+
+
+class Observer(ABC):
+    changes = DATA_CHANGES | {MEMBERSHIP}  # kinds of change the observer is notified of
+
+    def set_subject(self, subject):
+        self._subject = subject
+
+    @abstractmethod
+    def update(self, changes):
+        """
+        :param changes: dictionary of patient id -> set of the kinds of change to the patient
+        """
+        pass
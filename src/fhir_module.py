@@ -1,46 +1,107 @@
 from datetime import *
-import requests
 from abc import ABC, abstractmethod
-from src.patientdata_module import CholesterolData, BloodPressureData
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import itertools
+from time import monotonic
+from urllib.parse import quote
+import requests
+from src.transport_module import HTTPTransport
+from src.patientdata_module import CholesterolData, BloodPressureData, parse_effective_date
 from src.person_module import Patient, HealthPractitioner, PatientList, Address
 
 
 class FHIRClient(ABC):
-    def __init__(self, root_url):
+    observation_code = None  # LOINC code of the observations handled by the client
+    observation_count = 1  # number of latest observations kept per patient
+
+    def __init__(self, root_url, max_workers=8, transport=None):
+        """
+        :param root_url: base url of the FHIR server
+        :param max_workers: maximum number of requests sent to the server at the same time
+        :param transport: HTTPTransport shared with other clients, a new one is created if not given
+        """
         self._root_url = root_url
+        self._max_workers = max_workers
+        if transport is None:
+            transport = HTTPTransport(pool_size=max_workers)
+        self._transport = transport
+        self._last_updated = {}  # patient id -> server time of the last search which covered the patient
+        self._polling_policy = None
+
+    def set_polling_policy(self, polling_policy):
+        """
+        Poll each patient at their own rate in get_new_patients_data
+        :param polling_policy: AdaptivePollingPolicy, or None to request every patient every time
+        :return: None
+        """
+        self._polling_policy = polling_policy
+
+    def get_polling_policy(self):
+        """
+        :return: AdaptivePollingPolicy used by get_new_patients_data, None if every patient is requested every time
+        """
+        return self._polling_policy
 
     def get_patient_list(self, practitioner_id):
         """
         Query server and return a PatientList object for the corresponding practitioner identifier
+        Each distinct patient is resolved once: patients included in the encounter bundle are read directly,
+        the rest are requested on a worker pool while the encounter pages are still being read.
+        Patients are added to the list in the order they first appear in the encounters
         :param practitioner_id: identifier
         :return: PatientList
         """
         next_page = True
-        next_url = self._root_url + "Encounter?_include=Encounter.participant.individual&_include=" \
-                                    "Encounter.patient&participant.identifier=" \
+        next_url = self._root_url + "Encounter?_include=Encounter:patient&participant.identifier=" \
                                     "http://hl7.org/fhir/sid/us-npi|" + str(practitioner_id) + "&_count=50"
         page_count = 1
         patient_list = PatientList()
+        patient_ids = {}  # distinct subject ids, in order of first appearance
+        included_patients = {}  # patient id -> Patient, read from the bundle
+        pending_patients = {}  # patient id -> future, for patients missing from the bundle
 
-        while next_page:
-            res = requests.get(next_url)
-            data = res.json()
-            for encounter in data["entry"]:
-                patient_id = encounter["resource"]["subject"]["reference"].split("/")[1]
-                patient = self.get_basic_patient_info(patient_id)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while next_page:
+                res = self._transport.get(next_url)
+                data = res.json()
+                entries = data.get("entry", [])
+
+                # Read the included patient resources first, they come after the encounters in the bundle
+                for entry in entries:
+                    resource = entry["resource"]
+                    if resource["resourceType"] == "Patient" and resource["id"] not in included_patients:
+                        included_patients[resource["id"]] = self.parse_patient(resource)
+
+                for entry in entries:
+                    resource = entry["resource"]
+                    if resource["resourceType"] != "Encounter":
+                        continue
+                    patient_id = resource["subject"]["reference"].split("/")[1]
+                    if patient_id not in patient_ids:
+                        patient_ids[patient_id] = None
+                        if patient_id not in included_patients:
+                            pending_patients[patient_id] = executor.submit(self.get_basic_patient_info, patient_id)
+
+                next_page = False
+                links = data["link"]
+                for i in range(len(links)):
+                    link = links[i]
+                    if link["relation"] == "next":
+                        next_page = True
+                        next_url = link["url"]
+                        page_count += 1
+
+                # print(page_count)
+
+            # Collect the results in a stable order
+            for patient_id in patient_ids:
+                if patient_id in pending_patients:
+                    patient = pending_patients[patient_id].result()
+                else:
+                    patient = included_patients[patient_id]
                 if patient not in patient_list:
                     patient_list.add_patient(patient)
 
-            next_page = False
-            links = data["link"]
-            for i in range(len(links)):
-                link = links[i]
-                if link["relation"] == "next":
-                    next_page = True
-                    next_url = link["url"]
-                    page_count += 1
-
-            # print(page_count)
         return patient_list
 
     def get_practitioner_info(self, practitioner_id):
@@ -49,7 +110,7 @@ class FHIRClient(ABC):
         :param practitioner_id: identifier
         :return: HealthPractitioner object
         """
-        res = requests.get(
+        res = self._transport.get(
             self._root_url + "Practitioner?identifier=http://hl7.org/fhir/sid/us-npi|" + str(practitioner_id))
         data = res.json()
         name = data["entry"][0]["resource"]["name"][0]
@@ -63,8 +124,17 @@ class FHIRClient(ABC):
         :param patient_id: patient's id
         :return: Patient Object
         """
-        res = requests.get(self._root_url + "Patient/" + str(patient_id))
-        data = res.json()
+        res = self._transport.get(self._root_url + "Patient/" + str(patient_id))
+        return self.parse_patient(res.json())
+
+    @staticmethod
+    def parse_patient(data):
+        """
+        Build a Patient object from a FHIR Patient resource
+        :param data: Patient resource as json
+        :return: Patient Object
+        """
+        patient_id = data["id"]
 
         # Assign first and last name
         name = data["name"]
@@ -85,73 +155,268 @@ class FHIRClient(ABC):
         # Return patient object
         return Patient(first_name, last_name, patient_id, birth_date, gender, patient_address)
 
-    @abstractmethod
-    def get_patient_data(self, patient_id):
-        pass
-
-
-class CholesterolDataClient(FHIRClient):
     def get_patient_data(self, patient_id):
         """
-        Get the patient's cholesterol data from the server
+        Get the patient's latest observations of this client's data type from the server
         :param patient_id: patient's id
-        :return: CholesterolData object
+        :return: patient data object(s) built by parse_patient_data
         """
-        # Sort by decreasing date, only need 1 entry for latest value
-        res = requests.get(self._root_url + "Observation?patient=" +
-                           str(patient_id) +
-                           "&code=2093-3&_sort=-date&_count=1")
+        # Sort by decreasing date, only need the latest observations
+        res = self._transport.get(self._root_url + "Observation?patient=" + str(patient_id) +
+                                  "&code=" + self.observation_code +
+                                  "&_sort=-date&_count=" + str(self.observation_count))
 
         # Convert to json & extract relevant data
         data = res.json()
+        observations = [entry["resource"] for entry in data.get("entry", [])]
+        return self.parse_patient_data(observations)
+
+    def get_patients_data(self, patient_ids, batch_size=50, cancelled=None):
+        """
+        Get the latest observations of this client's data type for many patients at once
+        :param patient_ids: list of patient ids
+        :param batch_size: number of patients per search request
+        :param cancelled: optional threading.Event, once it is set the batches not requested yet are skipped
+        :return: dictionary of patient id -> patient data object(s) built by parse_patient_data, only the patients of
+        the batches which were requested if cancelled is set
+        """
+        patient_ids = [str(patient_id) for patient_id in patient_ids]
+        patient_data = {}
+        for batch_data in self.iter_patients_data(patient_ids, batch_size, cancelled):
+            patient_data.update(batch_data)
+        return {patient_id: patient_data[patient_id] for patient_id in patient_ids if patient_id in patient_data}
+
+    def iter_patients_data(self, patient_ids, batch_size=50, cancelled=None):
+        """
+        Get the latest observations of this client's data type for many patients, one batch at a time
+        Patients are split into batches, each batch is a single FHIR batch Bundle holding one search per patient and
+        code limited to the observations which are used, the batches are requested on the worker pool.
+        Patients whose observation cadence has not been learned yet get a longer history for the polling policy
+        :param patient_ids: list of patient ids
+        :param batch_size: number of patients per batch Bundle
+        :param cancelled: optional threading.Event, once it is set the batches not requested yet are skipped
+        :return: generator of dictionaries of patient id -> patient data object(s), in the order batches complete
+        """
+        patient_ids = [str(patient_id) for patient_id in patient_ids]
+        batches = [patient_ids[i:i + batch_size] for i in range(0, len(patient_ids), batch_size)]
+
+        def request_batch(batch):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            return self._request_latest_observations(batch)
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {executor.submit(request_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                if future.result() is None:  # skipped after the request was cancelled
+                    continue
+                observations, searched_at = future.result()
+                for patient_id in batch:
+                    self._last_updated[patient_id] = searched_at
+
+                # Learn how often each patient's observations are made
+                if self._polling_policy is not None:
+                    for patient_id in batch:
+                        if self._polling_policy.has_cadence(patient_id):
+                            continue
+                        effective_dates = [get_utc_date(observation) for observation in observations[patient_id]]
+                        self._polling_policy.set_cadence(patient_id, [effective_date for effective_date
+                                                                      in effective_dates if effective_date is not None])
+
+                yield {patient_id: self.parse_patient_data(observations[patient_id]) for patient_id in batch}
+
+    @classmethod
+    def get_observation_counts(cls):
+        """
+        :return: dictionary of observation code -> number of latest observations used by parse_patient_data
+        """
+        return {cls.observation_code: cls.observation_count}
+
+    def _request_latest_observations(self, patient_ids):
+        """
+        Request the latest observations of each patient of a batch with a FHIR batch Bundle
+        The Bundle holds one search per patient and observation code, each limited with _count to the number of
+        observations which are used, so the size of the response does not grow with the patients' history
+        :param patient_ids: list of patient ids
+        :return: tuple of (dictionary of patient id -> list of Observation resources, each code's observations
+        sorted by decreasing date, server time of the searches)
+        """
+        searches = []  # (patient id, url) of each entry of the Bundle
+        for patient_id in patient_ids:
+            for code, count in self.get_observation_counts().items():
+                if self._polling_policy is not None and not self._polling_policy.has_cadence(patient_id):
+                    count = max(count, self._polling_policy.cadence_observations)
+                searches.append((patient_id, "Observation?patient=" + patient_id + "&code=" + code +
+                                 "&_sort=-date&_count=" + str(count)))
+
+        bundle = {"resourceType": "Bundle", "type": "batch",
+                  "entry": [{"request": {"method": "GET", "url": url}} for _, url in searches]}
+        res = self._transport.post(self._root_url, json=bundle,
+                                   headers={"Content-Type": "application/fhir+json"})
+        res.raise_for_status()
+        data = res.json()
 
-        # Check if response contains cholesterol data
-        if data["total"] == 0:
+        observations = {patient_id: [] for patient_id in patient_ids}
+        searched_at = data.get("meta", {}).get("lastUpdated")
+        for (patient_id, url), entry in zip(searches, data.get("entry", [])):
+            status = entry.get("response", {}).get("status", "200")
+            if not status.startswith("2"):
+                raise requests.HTTPError("Search " + url + " of the batch failed: " + status)
+            search_result = entry.get("resource", {})
+            if searched_at is None:
+                searched_at = search_result.get("meta", {}).get("lastUpdated")
+            observations[patient_id].extend(result["resource"] for result in search_result.get("entry", []))
+        return observations, searched_at
+
+    def get_new_patients_data(self, patient_ids, batch_size=50, cancelled=None):
+        """
+        Get the latest observations only for the patients whose observations changed since they were last requested
+        For each batch of patients already requested before, a search with _lastUpdated only returns the
+        observations created or modified since then. Only the patients found in it, and the patients never
+        requested before, have their data requested and parsed again.
+        If a polling policy is set, only the patients due for a request are checked
+        Once cancelled is set no further request is sent. The changed patients found so far keep their previous
+        watermark, so they are found again by the next request
+        :param patient_ids: list of patient ids
+        :param batch_size: number of patients per search request
+        :param cancelled: optional threading.Event set when the request is no longer wanted
+        :return: dictionary of patient id -> patient data object(s), for the changed patients only. Only the
+        patients of the batches requested before cancelled was set
+        """
+        patient_ids = [str(patient_id) for patient_id in patient_ids]
+        poll_time = monotonic()  # the next polls are scheduled from the start of this one
+        if self._polling_policy is not None:
+            patient_ids = self._polling_policy.get_due_patients(patient_ids)
+        changed_ids = [patient_id for patient_id in patient_ids if self._last_updated.get(patient_id) is None]
+        known_ids = [patient_id for patient_id in patient_ids if self._last_updated.get(patient_id) is not None]
+        batches = [known_ids[i:i + batch_size] for i in range(0, len(known_ids), batch_size)]
+
+        def search_changes(batch):
+            if cancelled is not None and cancelled.is_set():
+                return None
+            since = min(self._last_updated[patient_id] for patient_id in batch)
+            return self._search_observations(batch, since)
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            for batch, result in zip(batches, executor.map(search_changes, batches)):
+                if result is None:  # skipped after the request was cancelled
+                    continue
+                resources, searched_at = result
+                batch_changed_ids = set(resource["subject"]["reference"].split("/")[1] for resource in resources)
+                for patient_id in batch:
+                    if patient_id in batch_changed_ids:
+                        changed_ids.append(patient_id)
+                    else:
+                        self._last_updated[patient_id] = searched_at
+
+        if cancelled is not None and cancelled.is_set():
+            return {}
+
+        if self._polling_policy is not None:
+            for patient_id in patient_ids:
+                self._polling_policy.record_poll(patient_id, patient_id in changed_ids, poll_time)
+
+        if len(changed_ids) == 0:
+            return {}
+        return self.get_patients_data(changed_ids, batch_size, cancelled)
+
+    def _search_observations(self, patient_ids, since=None):
+        """
+        Search the observations of this client's data type for a batch of patients, following every result page
+        Used with since to find which patients changed, only the observations changed since then are returned
+        :param patient_ids: list of patient ids
+        :param since: if given, only return observations created or modified at or after this server time
+        :return: tuple of (list of Observation resources sorted by decreasing date, server time of the search)
+        """
+        next_url = self._root_url + "Observation?patient=" + ",".join(patient_ids) + \
+            "&code=" + self.observation_code + "&_sort=-date&_count=200"
+        if since is not None:
+            next_url += "&_lastUpdated=ge" + quote(since, safe="")
+        resources = []
+        searched_at = None
+
+        while next_url is not None:
+            res = self._transport.get(next_url)
+            data = res.json()
+            resources.extend(entry["resource"] for entry in data.get("entry", []))
+            if searched_at is None:
+                searched_at = data.get("meta", {}).get("lastUpdated")
+
+            next_url = None
+            for link in data.get("link", []):
+                if link["relation"] == "next":
+                    next_url = link["url"]
+
+        return resources, searched_at
+
+    @classmethod
+    @abstractmethod
+    def parse_patient_data(cls, observations):
+        """
+        Convert a patient's Observation resources into patient data
+        Only the latest observation_count observations are used
+        :param observations: list of Observation resources sorted by decreasing date
+        :return: patient data object(s)
+        """
+        pass
+
+
+class CholesterolDataClient(FHIRClient):
+    observation_code = "2093-3"
+    observation_count = 1
+
+    @classmethod
+    def parse_patient_data(cls, observations):
+        """
+        Get the patient's cholesterol data from their observations
+        :param observations: list of cholesterol Observation resources sorted by decreasing date
+        :return: CholesterolData object
+        """
+        # Check if there is any cholesterol data, the latest observation with a readable date is used
+        latest_observation = next(iter_dated_observations(observations), None)
+        if latest_observation is None:
             return CholesterolData("-", "", "-")
 
-        # Assign cholesterol data
-        cholesterol_value = data["entry"][0]["resource"]["valueQuantity"]["value"]
-        cholesterol_unit = data["entry"][0]["resource"]["valueQuantity"]["unit"]
-        effective_date_time = data["entry"][0]["resource"]["effectiveDateTime"]
+        # Assign cholesterol data, values and dates are parsed once here
+        observation, effective_date_time = latest_observation
+        cholesterol_value = parse_quantity(observation["valueQuantity"]["value"])
+        cholesterol_unit = observation["valueQuantity"]["unit"]
 
-        # print("Returning patient data...")
         return CholesterolData(cholesterol_value, cholesterol_unit, effective_date_time)
 
 
 class BloodPressureDataClient(FHIRClient):
-    def get_patient_data(self, patient_id):
+    observation_code = "55284-4"
+    observation_count = 5
+
+    @classmethod
+    def parse_patient_data(cls, observations):
         """
-        Get the patient's cholesterol data from the server
-        :param patient_id: patient's id
-        :return: BloodPressureData object
+        Get the patient's latest blood pressure data from their observations
+        :param observations: list of blood pressure Observation resources sorted by decreasing date
+        :return: list of BloodPressureData objects
         """
-        # Sort by decreasing date, get 5 latest observations
-        res = requests.get(self._root_url + "Observation?patient=" +
-                           str(patient_id) + "&code=55284-4&_sort=-date&_count=5"
-                           )
+        # Observations without a readable date are left out
+        observations = list(itertools.islice(iter_dated_observations(observations), cls.observation_count))
 
-        # Convert to json & extract relevant data
-        data = res.json()
-
-        # Check if response contains cholesterol data
-        if data["total"] == 0:
+        # Check if there is any blood pressure data
+        if len(observations) == 0:
             return [BloodPressureData("-", "-", "", "-")]
 
-        systolic_blood_pressure = None
-        diastolic_blood_pressure = None
-        unit = None
-        effective_date_time = data["entry"][0]["resource"]["effectiveDateTime"]
         latest_observations = []
 
-        # Assign cholesterol data
-        for observation in data["entry"]:
-            components = observation["resource"]["component"]
-            for component in components:
+        # Assign blood pressure data
+        for observation, effective_date_time in observations:
+            systolic_blood_pressure = None
+            diastolic_blood_pressure = None
+            unit = None
+            for component in observation["component"]:
                 if component["code"]["coding"][0]["code"] == "8480-6":  # Systolic Blood Pressure
-                    systolic_blood_pressure = component["valueQuantity"]["value"]
+                    systolic_blood_pressure = parse_quantity(component["valueQuantity"]["value"])
                     unit = component["valueQuantity"]["unit"]
                 elif component["code"]["coding"][0]["code"] == "8462-4":  # Diastolic Blood Pressure
-                    diastolic_blood_pressure = component["valueQuantity"]["value"]
+                    diastolic_blood_pressure = parse_quantity(component["valueQuantity"]["value"])
 
             # Add to array of blood pressure data
             latest_observations.append(BloodPressureData(
@@ -161,6 +426,88 @@ class BloodPressureDataClient(FHIRClient):
         return latest_observations
 
 
+class CombinedDataClient(FHIRClient):
+    """
+    Client which requests the cholesterol and blood pressure observations of a patient in a single search
+    """
+    observation_code = CholesterolDataClient.observation_code + "," + BloodPressureDataClient.observation_code
+
+    @classmethod
+    def get_observation_counts(cls):
+        """
+        :return: dictionary of observation code -> number of latest observations used by parse_patient_data
+        """
+        return dict(CholesterolDataClient.get_observation_counts(), **BloodPressureDataClient.get_observation_counts())
+
+    def get_patient_data(self, patient_id):
+        """
+        Get the patient's cholesterol and blood pressure data from the server
+        The latest observation of one type can be older than many observations of the other type,
+        so each type is searched with its own limit
+        :param patient_id: patient's id
+        :return: tuple of (CholesterolData object, list of BloodPressureData objects)
+        """
+        return self.get_patients_data([patient_id])[str(patient_id)]
+
+    @classmethod
+    def parse_patient_data(cls, observations):
+        """
+        Split the patient's observations by code and parse each type with its own client
+        :param observations: list of cholesterol and blood pressure Observation resources sorted by decreasing date
+        :return: tuple of (CholesterolData object, list of BloodPressureData objects)
+        """
+        cholesterol_observations = []
+        blood_pressure_observations = []
+        for observation in observations:
+            code = observation["code"]["coding"][0]["code"]
+            if code == CholesterolDataClient.observation_code:
+                cholesterol_observations.append(observation)
+            elif code == BloodPressureDataClient.observation_code:
+                blood_pressure_observations.append(observation)
+
+        return (CholesterolDataClient.parse_patient_data(cholesterol_observations),
+                BloodPressureDataClient.parse_patient_data(blood_pressure_observations))
+
+
+def iter_dated_observations(observations):
+    """
+    Pair observations with their parsed effective date, the observations whose date cannot be read are reported
+    and left out
+    :param observations: list of Observation resources
+    :return: generator of (Observation resource, datetime) tuples, in the order of the observations
+    """
+    for observation in observations:
+        effective_date = parse_effective_date(observation.get("effectiveDateTime"))
+        if effective_date is None:
+            print("Skipped observation " + str(observation.get("id")) + " with effective date " +
+                  repr(observation.get("effectiveDateTime")))
+            continue
+        yield observation, effective_date
+
+
+def get_utc_date(observation):
+    """
+    :param observation: Observation resource
+    :return: effective datetime of the observation with a time zone, dates without one are taken as UTC. None if
+    the observation has no readable effectiveDateTime
+    """
+    effective_date = parse_effective_date(observation.get("effectiveDateTime"))
+    if effective_date is not None and effective_date.tzinfo is None:
+        effective_date = effective_date.replace(tzinfo=timezone.utc)
+    return effective_date
+
+
+def parse_quantity(value):
+    """
+    Convert the value of a FHIR Quantity to a float
+    :param value: value as found in the resource, a number or a numeric string
+    :return: float, None if there is no value
+    """
+    if value is None:
+        return None
+    return float(value)
+
+
 if __name__ == '__main__':
     client = BloodPressureDataClient("https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/")
     # patients = client.get_patient_list(21550)
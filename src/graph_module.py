@@ -0,0 +1,251 @@
+from abc import abstractmethod
+import numpy as np
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+from src.event_module import Observer, CHOLESTEROL, BLOOD_PRESSURE, MEMBERSHIP
+
+
+class GraphicalMonitor(Observer, Figure):
+    """
+    Figure which observes a patient list and keeps its artists up to date with the patients' data
+    The artists are created once and updated in place. While the data still fits the axes only the artists are
+    redrawn over the saved background (blitting), otherwise the whole figure is redrawn once Tk is idle
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._subject = None
+        self._window = None
+        self._background = None  # figure without the artists, saved after each full draw
+        self._artists = []  # artists drawn over the background
+
+    def show_in(self, window):
+        """
+        Draw the figure in a Tk window, the figure stops observing its patient list when the window is closed
+        :param window: tkinter Toplevel
+        :return: None
+        """
+        self._window = window
+        canvas = FigureCanvasTkAgg(self, master=window)
+        canvas.get_tk_widget().grid()
+        canvas.mpl_connect("draw_event", self._on_draw)
+        window.bind("<Destroy>", self._on_destroy, add="+")
+        self.refresh()
+
+    def update(self, changes):
+        if self._subject is not None:  # If subject has not been specified, do nothing
+            self.refresh()
+
+    def refresh(self):
+        """
+        Update the artists with the data of the observed patient list and redraw them
+        :return: None
+        """
+        if self._subject is None:
+            return
+        layout_changed = self.update_artists(self._subject)
+        if self.canvas is None or self._window is None:
+            return
+        if layout_changed or self._background is None:
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self._background)
+            for artist in self._artists:
+                self.draw_artist(artist)
+            self.canvas.blit(self.bbox)
+
+    @abstractmethod
+    def update_artists(self, patient_list):
+        """
+        Update the artists with the patients' data
+        :param patient_list: PatientList object being observed
+        :return: True if the axes or the set of artists changed and the whole figure must be redrawn
+        """
+        pass
+
+    def set_artists(self, artists):
+        """
+        Set the artists which are drawn over the background, they are only drawn by blitting
+        :param artists: list of matplotlib artists
+        :return: None
+        """
+        for artist in artists:
+            artist.set_animated(True)
+        self._artists = artists
+
+    def _on_draw(self, event):
+        # Save the background without the artists, then draw them on top
+        self._background = self.canvas.copy_from_bbox(self.bbox)
+        for artist in self._artists:
+            self.draw_artist(artist)
+
+    def _on_destroy(self, event):
+        # <Destroy> is also received for each widget inside the window
+        if event.widget is self._window:
+            if self._subject is not None:
+                self._subject.detach(self)
+            self._window = None
+
+
+class BarGraph(GraphicalMonitor):
+    """
+    Bar graphs of one value per patient, one subplot per value type
+    The bars are kept while the graphed patients stay the same, only their heights and labels are updated
+    """
+
+    def __init__(self, titles, y_labels, *args, **kwargs):
+        """
+        :param titles: title of each subplot
+        :param y_labels: y axis label of each subplot
+        """
+        super().__init__(*args, **kwargs)
+        self._subplots = []
+        for index, (title, y_label) in enumerate(zip(titles, y_labels)):
+            subplot = self.add_subplot(1, len(titles), index + 1)
+            subplot.set_title(title)
+            subplot.set_xlabel("Patient Names")
+            subplot.set_ylabel(y_label)
+            self._subplots.append(subplot)
+        self._names = None  # names of the graphed patients
+        self._bars = []  # bar container of each subplot
+        self._labels = []  # list of value labels of each subplot
+
+    @abstractmethod
+    def get_graph_data(self, patient_list):
+        """
+        :param patient_list: PatientList object
+        :return: tuple of (names of the graphed patients, list of arrays of values, one per subplot)
+        """
+        pass
+
+    def update_artists(self, patient_list):
+        names, values = self.get_graph_data(patient_list)
+        if names != self._names:
+            self._create_bars(names, values)
+            return True
+
+        layout_changed = False
+        for subplot, bars, labels, subplot_values in zip(self._subplots, self._bars, self._labels, values):
+            for bar, label, value in zip(bars, labels, subplot_values.tolist()):
+                if bar.get_height() != value:
+                    bar.set_height(value)
+                    label.set_y(value + 1)
+                    label.set_text(_format_value(value))
+            if len(subplot_values) > 0 and subplot_values.max() + 1 > subplot.get_ylim()[1]:
+                subplot.relim()
+                subplot.autoscale_view()
+                layout_changed = True
+        return layout_changed
+
+    def _create_bars(self, names, values):
+        for bars, labels in zip(self._bars, self._labels):
+            bars.remove()
+            for label in labels:
+                label.remove()
+        self._names = names
+        self._bars = []
+        self._labels = []
+        artists = []
+        for subplot, subplot_values in zip(self._subplots, values):
+            bars = subplot.bar(names, subplot_values)
+            labels = [subplot.text(bar.get_x(), bar.get_height() + 1, _format_value(bar.get_height()))
+                      for bar in bars]
+            subplot.relim()
+            subplot.autoscale_view()
+            self._bars.append(bars)
+            self._labels.append(labels)
+            artists.extend(bars)
+            artists.extend(labels)
+        self.set_artists(artists)
+
+
+class CholesterolGraph(BarGraph):
+    """
+    Bar graph of the latest cholesterol value of each patient
+    """
+    changes = {CHOLESTEROL, MEMBERSHIP}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(("Patient Cholesterol Data",), ("Cholesterol Values (mg/dL)",), *args, **kwargs)
+
+    def get_graph_data(self, patient_list):
+        patients = patient_list.get_patient_list()
+        cholesterol = patient_list.get_cholesterol_values()
+        has_value = ~np.isnan(cholesterol)
+        names = [patient.first_name + " " + patient.last_name
+                 for patient, graphed in zip(patients, has_value.tolist()) if graphed]
+        return names, [cholesterol[has_value]]
+
+
+class BloodPressureGraph(BarGraph):
+    """
+    Bar graphs of the latest systolic and diastolic values of each patient
+    """
+    changes = {BLOOD_PRESSURE, MEMBERSHIP}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(("Patient Systolic Data", "Patient Diastolic Data"),
+                         ("Systolic Blood Pressure Values (mmHg)", "Diastolic Blood Pressure Values (mmHg)"),
+                         *args, **kwargs)
+
+    def get_graph_data(self, patient_list):
+        patients = patient_list.get_patient_list()
+        systolic, diastolic = patient_list.get_blood_pressure_values()
+        has_value = ~np.isnan(systolic) & ~np.isnan(diastolic)
+        names = [patient.first_name + " " + patient.last_name
+                 for patient, graphed in zip(patients, has_value.tolist()) if graphed]
+        return names, [systolic[has_value], diastolic[has_value]]
+
+
+class SystolicHistoryGraph(GraphicalMonitor):
+    """
+    Line graph of a patient's latest systolic values, in chronological order
+    """
+    changes = {BLOOD_PRESSURE}
+
+    def __init__(self, patient, *args, **kwargs):
+        """
+        :param patient: Patient object whose values are graphed
+        """
+        super().__init__(*args, **kwargs)
+        self._patient = patient
+        self._subplot = self.add_subplot(1, 1, 1)
+        self._subplot.set_title(patient.first_name + " " + patient.last_name + "'s Systolic Blood Pressure Data")
+        self._subplot.set_xlabel("Observations")
+        self._subplot.set_ylabel("Systolic Blood Pressure Values (mmHg)")
+        self._line, = self._subplot.plot([], [])
+        self.set_artists([self._line])
+
+    def update(self, changes):
+        if self._patient.id in changes:
+            super().update(changes)
+
+    def update_artists(self, patient_list):
+        y_values = []
+        for i in range(5):  # the latest 5 systolic observations
+            systolic_value = self._patient.get_blood_pressure_value(i)[0]
+            if systolic_value is not None:
+                y_values.append(systolic_value)
+        y_values.reverse()  # chronological order
+        x_values = list(range(1, len(y_values) + 1))
+
+        old_x_values, old_y_values = self._line.get_data()
+        if list(old_x_values) == x_values and list(old_y_values) == y_values:
+            return False
+        self._line.set_data(x_values, y_values)
+
+        # Rescale the axes only when the line no longer fits
+        x_min, x_max = self._subplot.get_xlim()
+        y_min, y_max = self._subplot.get_ylim()
+        if len(y_values) > 0 and (len(x_values) > x_max or min(y_values) < y_min or max(y_values) > y_max):
+            self._subplot.relim()
+            self._subplot.autoscale_view()
+            return True
+        return False
+
+
+def _format_value(value):
+    """Label of a bar, whole numbers are shown without decimals"""
+    if float(value).is_integer():
+        return str(int(value))
+    return str(value)
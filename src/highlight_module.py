@@ -0,0 +1,94 @@
+HIGH_CHOLESTEROL = "high cholesterol"
+HIGH_SYSTOLIC = "high systolic pressure"
+HIGH_DIASTOLIC = "high diastolic pressure"
+HIGH_BLOOD_PRESSURE = "high blood pressure"
+NORMAL = "normal"
+
+CHOLESTEROL_COLOURS = {NORMAL: None, HIGH_CHOLESTEROL: "red"}
+BLOOD_PRESSURE_COLOURS = {NORMAL: None, HIGH_SYSTOLIC: "green", HIGH_DIASTOLIC: "blue", HIGH_BLOOD_PRESSURE: "purple"}
+
+
+def classify_cholesterol(patient, average_cholesterol_level):
+    """
+    Alert class of a patient's latest cholesterol value
+    :param patient: Patient object
+    :param average_cholesterol_level: average cholesterol of the monitored patients
+    :return: HIGH_CHOLESTEROL if the value is above the average, NORMAL otherwise, None if there is no value
+    """
+    cholesterol = patient.get_cholesterol_value()
+    if cholesterol is None:
+        return None
+    if cholesterol > average_cholesterol_level:
+        return HIGH_CHOLESTEROL
+    return NORMAL
+
+
+def classify_blood_pressure(patient, systolic_limit, diastolic_limit):
+    """
+    Alert class of a patient's latest blood pressure observation
+    :param patient: Patient object
+    :param systolic_limit: systolic values above this limit are high
+    :param diastolic_limit: diastolic values above this limit are high
+    :return: HIGH_BLOOD_PRESSURE if both values are high, HIGH_SYSTOLIC or HIGH_DIASTOLIC if one of them is,
+    NORMAL otherwise, None if there is no observation
+    """
+    systolic, diastolic = patient.get_blood_pressure_value(0)
+    if systolic is None or diastolic is None:
+        return None
+    if systolic > systolic_limit and diastolic > diastolic_limit:
+        return HIGH_BLOOD_PRESSURE
+    if systolic > systolic_limit:
+        return HIGH_SYSTOLIC
+    if diastolic > diastolic_limit:
+        return HIGH_DIASTOLIC
+    return NORMAL
+
+
+class RowHighlighter:
+    """
+    Applies alert classes to the rows of a Treeview as tags
+    The class last applied to each row is remembered, so a refresh only writes the rows whose class changed
+    """
+
+    def __init__(self, tree, tag_colours):
+        """
+        :param tree: tkinter Treeview whose rows are highlighted
+        :param tag_colours: dictionary of alert class -> text colour, None for the default colour
+        """
+        self._tree = tree
+        self._tags = {}  # item -> alert class applied to the row
+        for tag, colour in tag_colours.items():
+            tree.tag_configure(tag, foreground=colour)
+
+    def highlight(self, item_classes):
+        """
+        Apply the alert class of every row, rows which are not given are forgotten
+        :param item_classes: dictionary of item -> alert class, None to remove the row's highlighting
+        :return: number of rows written
+        """
+        written = 0
+        for item, tag in item_classes.items():
+            if self._tags.get(item) != tag:
+                if tag is None:
+                    self._tree.item(item, tags=[])
+                else:
+                    self._tree.item(item, tags=[tag])
+                self._tags[item] = tag
+                written += 1
+
+        # Rows which were deleted from the Treeview
+        if len(self._tags) > len(item_classes):
+            for item in set(self._tags).difference(item_classes):
+                del self._tags[item]
+        return written
+
+    def forget(self, item=None):
+        """
+        Forget the class applied to a row, so it is written on the next refresh
+        :param item: item of the row, None to forget every row
+        :return: None
+        """
+        if item is None:
+            self._tags.clear()
+        else:
+            self._tags.pop(item, None)
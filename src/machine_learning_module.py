@@ -1,15 +1,42 @@
 import numpy as np
 import pandas as pd
-import requests
 import csv
+import hashlib
+import itertools
+import json
+import math
+import os
+import time
+import zipfile
+from datetime import timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import quote
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LinearRegression
+from src.transport_module import HTTPTransport
+from src.patientdata_module import parse_effective_date
+
+DATA_SET_FIELDNAMES = ["PATIENT ID", "BLOOD PRESSURE", "GLUCOSE", "TOBACCO INTAKE",
+                       "BMI", "SODIUM", "WEIGHT", "CHOLESTEROL"]  # columns of patient_data_set.csv
+PATIENT_DATA_CSV = "Machine Learning Data/patient_data.csv"
+DATA_SET_CACHE = "Machine Learning Data/patient_data_set.npz"
 
 
 class MachineLearningClient:
 
-    def __init__(self, root_url):
+    def __init__(self, root_url, max_workers=8, page_size=100, transport=None):
+        """
+        :param root_url: base url of the FHIR server
+        :param max_workers: maximum number of requests sent to the server at the same time
+        :param page_size: number of observations requested per page of a patient's search
+        :param transport: HTTPTransport shared with other clients, a new one is created if not given
+        """
         self._root_url = root_url
+        self._max_workers = max_workers
+        self._page_size = page_size
+        if transport is None:
+            transport = HTTPTransport(pool_size=max_workers)
+        self._transport = transport
 
     def patient_id_csv(self):
         """
@@ -30,7 +57,7 @@ class MachineLearningClient:
 
             while next_page:
                 # returns all the patients
-                res = requests.get(next_url)
+                res = self._transport.get(next_url)
                 # Convert to json & extract relevant data
                 data = res.json()
 
@@ -68,7 +95,7 @@ class MachineLearningClient:
 
             for patient_id in read_id_file:
                 # Gets patients other diagnostics
-                res = requests.get(self._root_url + "Observation?patient=" + str(patient_id[0]))
+                res = self._transport.get(self._root_url + "Observation?patient=" + str(patient_id[0]))
                 # Convert to json & extract relevant data
                 data = res.json()
 
@@ -125,105 +152,294 @@ class MachineLearningClient:
                     all_data_codes.append(data_code)
             return all_data_codes
 
-    def data_chart(self):
+    def get_data_values(self, patient_id, data_codes):
+        """
+        Requests the latest observation of a patient for every data code, with a single search for all the codes.
+        The results are sorted by date, so the first observation found for a code is its latest one and further pages
+        are only requested while some codes have not been found.
+        :param patient_id: patient id
+        :param data_codes: list of data codes
+        :return: dictionary of data code -> (diagnostic description, value), ("No Data", "0") if the patient has
+        no value for the code
+        """
+        data_values = {}
+        next_url = self._root_url + "Observation?patient=" + str(patient_id) + "&code=" + ",".join(data_codes) + \
+            "&_sort=-date&_count=" + str(self._page_size)
+
+        while next_url is not None and len(data_values) < len(data_codes):
+            res = self._transport.get(next_url)
+            data = res.json()
+
+            for entry in data.get("entry", []):
+                resource = entry["resource"]
+                for coding in resource["code"]["coding"]:
+                    data_code = coding["code"]
+                    if data_code in data_codes and data_code not in data_values:
+                        data_values[data_code] = get_observation_value(resource, data_code)
+
+            next_url = None
+            for link in data.get("link", []):
+                if link["relation"] == "next":
+                    next_url = link["url"]
+
+        return {data_code: data_values.get(data_code, ("No Data", "0")) for data_code in data_codes}
+
+    def data_chart(self, resume=True):
         """
         Writes a CSV file containing the most useful data codes and the value that is respective
         to the patient, using their patient id.
+        Each patient's data codes are requested with a single search, on a bounded worker pool. Each finished pair
+        is saved in a checkpoint file, so a harvest which stopped part way only requests the remaining patients when
+        run again.
+        Rows are written to the CSV file as soon as every pair before them has finished, in the same order as before.
+        :param resume: reuse the pairs saved by a previous harvest which did not finish
         :return: List of the patient data.
         """
 
-        with open("Machine Learning Data/patient_data.csv", "w", newline="") as patient_data_file:
-            fieldnames = ["PATIENT ID", "DIAGNOSTIC DESCRIPTION", "VALUE"]
+        patient_ids = self.read_id_csv()
+        data_codes = self.read_data_csv()
+        pairs = [(patient_id, data_code) for patient_id in patient_ids for data_code in data_codes]
+
+        checkpoint = HarvestCheckpoint("Machine Learning Data/patient_data_checkpoint.csv")
+        if not resume:
+            checkpoint.clear()
+        results = checkpoint.load()  # (patient id, data code) -> (diagnostic description, value)
+        if len(results) > 0:
+            print(f"Resuming harvest, {len(results)} of {len(pairs)} values already requested")
+
+        with open(PATIENT_DATA_CSV, "w", newline="") as patient_data_file:
+            fieldnames = ["PATIENT ID", "DIAGNOSTIC DESCRIPTION", "VALUE", "DATA CODE"]
             file_writer = csv.DictWriter(patient_data_file, fieldnames=fieldnames)
             file_writer.writeheader()
 
-            patient_ids = self.read_id_csv()
-            data_codes = self.read_data_csv()
             patient_data = []
-
-            for patient_id in patient_ids:
-                for data_code in data_codes:
-                    res = requests.get(self._root_url + "Observation?patient=" + str(patient_id) +
-                                       "&code=" + str(data_code) + "&_sort=-date")
-                    data = res.json()
-
-                    try:
-                        data_description = data["entry"][0]["resource"]["code"]["coding"][0]["display"]
-                        data_value = data["entry"][0]["resource"]["valueQuantity"]["value"]
-                    except KeyError:
-
-                        if data_code == "55284-4":  # Blood pressure
-                            components = data["entry"][0]["resource"]["component"]
-                            for component in components:
-                                if component["code"]["coding"][0]["code"] == "8480-6":  # Systolic Blood Pressure
-                                    data_description = component["code"]["coding"][0]["display"]
-                                    data_value = component["valueQuantity"]["value"]
-                                    break
-
-                        elif data_code == "72166-2":  # Smoking status
-                            data_description = data["entry"][0]["resource"]["code"]["coding"][0]["display"]
-                            data_value = data["entry"][0]["resource"]["valueCodeableConcept"]["coding"][0]["code"]
-
-                        else:
-                            data_description = "No Data"
-                            data_value = "0"
-
-                    patient_data_value = patient_id, data_description, data_value
-                    patient_data.append(patient_data_value)
-
-                    file_writer.writerow({"PATIENT ID": patient_data_value[0],
-                                          "DIAGNOSTIC DESCRIPTION": patient_data_value[1],
-                                          "VALUE": patient_data_value[2]})
-            return patient_data
+            next_row = 0  # index of the next pair written to the CSV file
+
+            def write_finished_rows():
+                nonlocal next_row
+                while next_row < len(pairs) and pairs[next_row] in results:
+                    patient_id, data_code = pairs[next_row]
+                    data_description, data_value = results[pairs[next_row]]
+                    patient_data.append((patient_id, data_description, data_value))
+                    file_writer.writerow({"PATIENT ID": patient_id,
+                                          "DIAGNOSTIC DESCRIPTION": data_description,
+                                          "VALUE": data_value,
+                                          "DATA CODE": data_code})
+                    next_row += 1
+
+            # Patients with data codes which have not been requested yet
+            remaining = iter([patient_id for patient_id in dict.fromkeys(patient_ids)
+                              if any((patient_id, data_code) not in results for data_code in data_codes)])
+            pending = {}  # future -> patient id
+            write_finished_rows()
+
+            with checkpoint, ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                # Only a few requests per worker are queued at a time, so memory does not grow with the harvest
+                for patient_id in itertools.islice(remaining, 2 * self._max_workers):
+                    pending[executor.submit(self.get_data_values, patient_id, data_codes)] = patient_id
+
+                while len(pending) > 0:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        patient_id = pending.pop(future)
+                        try:
+                            data_values = future.result()
+                        except Exception:
+                            # Stop the harvest, the finished patients are kept in the checkpoint file
+                            for other in pending:
+                                other.cancel()
+                            print(f"Harvest stopped after {len(results)} of {len(pairs)} values, "
+                                  f"run it again to resume")
+                            raise
+                        for data_code, data_value in data_values.items():
+                            results[(patient_id, data_code)] = data_value
+                            checkpoint.add((patient_id, data_code), data_value)
+                        for next_patient_id in itertools.islice(remaining, 1):
+                            pending[executor.submit(self.get_data_values, next_patient_id, data_codes)] = \
+                                next_patient_id
+                    write_finished_rows()
+
+        checkpoint.clear()
+        return patient_data
+
+    def bulk_export(self, export_dir="Machine Learning Data/export", poll_interval=5):
+        """
+        Downloads the patients and the observations of the data codes with a FHIR Bulk Data $export request.
+        The export runs on the server in the background, its status is polled until the NDJSON files are ready,
+        then each file is streamed to disk in chunks.
+        :param export_dir: directory the NDJSON files are written to
+        :param poll_interval: seconds between two status requests when the server does not give a Retry-After
+        :return: list of paths of the downloaded files
+        """
+        data_codes = self.read_data_csv()
+        res = self._transport.get(self._root_url + "$export?_type=Patient,Observation&_typeFilter=" +
+                                  quote("Observation?code=" + ",".join(data_codes), safe=""),
+                                  headers={"Prefer": "respond-async"})
+        if res.status_code != 202:
+            raise RuntimeError(f"$export was not accepted by the server ({res.status_code}): {res.text}")
+        status_url = res.headers["Content-Location"]
+
+        # Wait for the export to finish
+        res = self._transport.get(status_url)
+        while res.status_code == 202:
+            retry_after = res.headers.get("Retry-After", "")
+            time.sleep(int(retry_after) if retry_after.isdigit() else poll_interval)
+            res = self._transport.get(status_url)
+        if res.status_code != 200:
+            raise RuntimeError(f"$export failed ({res.status_code}): {res.text}")
+        manifest = res.json()
+
+        os.makedirs(export_dir, exist_ok=True)
+        export_files = []
+        for index, output in enumerate(manifest.get("output", [])):
+            path = os.path.join(export_dir, f"{output['type']}.{index}.ndjson")
+            res = self._transport.get(output["url"], headers={"Accept": "application/fhir+ndjson"}, stream=True)
+            res.raise_for_status()
+            with open(path, "wb") as export_file:
+                for chunk in res.iter_content(chunk_size=1 << 16):
+                    export_file.write(chunk)
+            export_files.append(path)
+        return export_files
+
+    def bulk_data_set(self, export_dir="Machine Learning Data/export", write_csv=False):
+        """
+        Builds the data set from the NDJSON files of a bulk export, instead of searching each patient, and saves it
+        in the data set cache.
+        The files are read one line at a time, only the latest value of each patient and data code is kept in memory.
+        Patients are the ones in the Patient files, in file order, or the subjects of the observations if the export
+        has no Patient file.
+        :param export_dir: directory containing the NDJSON files, as written by bulk_export
+        :param write_csv: also write patient_data_set.csv
+        :return: DataFrame of data values indexed by patient id, NaN where a patient has no value for a data code.
+        """
+        data_codes = self.read_data_csv()
+        patient_ids = {}  # patient ids, in order of appearance
+        latest_values = {}  # (patient id, data code) -> (effective time, value)
+
+        for path in self._get_source_files(export_dir):
+            if not path.endswith(".ndjson"):
+                continue
+            for resource in read_ndjson(path):
+                if resource["resourceType"] == "Patient":
+                    patient_ids[resource["id"]] = None
+
+                elif resource["resourceType"] == "Observation" and "subject" in resource:
+                    patient_id = resource["subject"]["reference"].split("/")[-1]
+                    effective_time = get_effective_time(resource)
+                    for coding in resource["code"]["coding"]:
+                        data_code = coding["code"]
+                        if data_code not in data_codes:
+                            continue
+                        latest_value = latest_values.get((patient_id, data_code))
+                        if latest_value is None or effective_time > latest_value[0]:
+                            latest_values[(patient_id, data_code)] = \
+                                (effective_time, get_observation_value(resource, data_code))
+
+        if len(patient_ids) == 0:
+            patient_ids = dict.fromkeys(patient_id for patient_id, _ in latest_values)
+
+        # Same long rows as patient_data.csv, so both paths share the pivot
+        rows = [(patient_id, data_code) + latest_value[1] for (patient_id, data_code), latest_value
+                in latest_values.items() if patient_id in patient_ids]
+        patient_data = pd.DataFrame(rows, columns=["PATIENT ID", "DATA CODE", "DIAGNOSTIC DESCRIPTION", "VALUE"])
+        data_set = pivot_patient_data(patient_data, data_codes).reindex(list(patient_ids))
+        data_set.index.name = DATA_SET_FIELDNAMES[0]
+
+        DataSetCache(DATA_SET_CACHE).save(data_set, export_dir, self._get_source_files(export_dir))
+        if write_csv:
+            self.write_data_set_csv(data_set)
+        return data_set
 
     def set_data_values_array(self):
         """
         Sets the data into a more readable view, and so that the data is organised in columns.
-        :return: List of data values.
+        patient_data.csv is pivoted into one row per patient id and one numeric column per data code.
+        :return: DataFrame of data values indexed by patient id, NaN where a patient has no value for a data code.
+        """
+        # "No Data" values are read as NaN, so the parser reads the values as floats rather than as text
+        patient_data = pd.read_csv(PATIENT_DATA_CSV,
+                                   dtype={"PATIENT ID": str, "DIAGNOSTIC DESCRIPTION": str, "DATA CODE": str},
+                                   na_values={"VALUE": ["No Data"]})
+        return pivot_patient_data(patient_data, self.read_data_csv())
+
+    def get_data_values_array(self, write_csv=False):
         """
+        Builds the data set respective to the patient, using their patient id, from patient_data.csv and saves it in
+        the data set cache.
+        :param write_csv: also write patient_data_set.csv
+        :return: DataFrame of data values indexed by patient id, NaN where a patient has no value for a data code.
+        """
+        patient_values = self.set_data_values_array()
+        patient_ids = list(dict.fromkeys(self.read_id_csv()))
 
-        with open("Machine Learning Data/patient_data.csv", "r") as patient_data_file:
-            read_patient_data_file = csv.reader(patient_data_file, delimiter=",")
-            patient_data_file.readline()
-            data_values = []
+        # Patients without any row in patient_data.csv are missing every value
+        patient_values = patient_values.reindex(patient_ids)
+        patient_values.index.name = DATA_SET_FIELDNAMES[0]
 
-            for data in read_patient_data_file:
-                data_values.append(data[2])
+        DataSetCache(DATA_SET_CACHE).save(patient_values, PATIENT_DATA_CSV, self._get_source_files(PATIENT_DATA_CSV))
+        if write_csv:
+            self.write_data_set_csv(patient_values)
+        return patient_values
 
-            data_values_array = np.array(data_values).reshape((-1, 7))
-            return data_values_array
+    def export_data_set_csv(self, export_dir=None):
+        """
+        Builds the data set and writes patient_data_set.csv, the CSV file is only written on demand through this method.
+        :param export_dir: directory of a bulk export to build the data set from, patient_data.csv if not given
+        :return: DataFrame of data values indexed by patient id, NaN where a patient has no value for a data code.
+        """
+        if export_dir is not None:
+            return self.bulk_data_set(export_dir, write_csv=True)
+        return self.get_data_values_array(write_csv=True)
 
-    def get_data_values_array(self):
+    def write_data_set_csv(self, data_set):
         """
-        Writes the data values out respective to the patient, using their patient id, to a CSV file.
+        Writes the data set to patient_data_set.csv, missing values are written as 0.
+        :param data_set: DataFrame returned by get_data_values_array or bulk_data_set
         :return: None
         """
+        missing_values = int(data_set.isna().sum().sum())
+        if missing_values > 0:
+            print(f"{missing_values} of {data_set.size} data values are missing, they are written as 0")
 
-        with open("Machine Learning Data/patient_data_set.csv", "w", newline="") as patient_values_file:
-            fieldnames = ["PATIENT ID", "BLOOD PRESSURE", "GLUCOSE", "TOBACCO INTAKE",
-                          "BMI", "SODIUM", "WEIGHT", "CHOLESTEROL"]
-            file_writer = csv.DictWriter(patient_values_file, fieldnames=fieldnames)
-            file_writer.writeheader()
+        data_set = data_set.fillna(0)
+        data_set.index.name = DATA_SET_FIELDNAMES[0]
+        data_set.to_csv("Machine Learning Data/patient_data_set.csv", float_format="%.15g", lineterminator="\r\n")
 
-            patient_values = self.set_data_values_array()
-            patient_ids = self.read_id_csv()
-
-            check_id = True
-            while check_id:
-                for patient_value in patient_values:
-                    for patient_id in patient_ids:
-                        file_writer.writerow({"PATIENT ID": patient_id,
-                                              "BLOOD PRESSURE": patient_value[0],
-                                              "GLUCOSE": patient_value[1],
-                                              "TOBACCO INTAKE": patient_value[2],
-                                              "BMI": patient_value[3],
-                                              "SODIUM": patient_value[4],
-                                              "WEIGHT": patient_value[5],
-                                              "CHOLESTEROL": patient_value[6]})
-                        patient_ids.pop(0)
-                        check_id = False
-                        if not check_id:
-                            break
+    def load_data_set(self):
+        """
+        Loads the data set from the data set cache. The cache is rebuilt from its source, patient_data.csv or an
+        export directory, if the source files changed since it was saved, and from patient_data.csv if there is no
+        cache yet. patient_data_set.csv is only read when neither exists.
+        :return: DataFrame of data values indexed by patient id, NaN where a patient has no value for a data code.
+        """
+        cache = DataSetCache(DATA_SET_CACHE)
+        source = cache.get_source()
+        if source is not None:
+            data_set = cache.load(self._get_source_files(source))
+            if data_set is not None:
+                return data_set
+            print("The data set cache is out of date or damaged, rebuilding it from " + source)
+
+        if source is not None and os.path.isdir(source):
+            return self.bulk_data_set(source)
+        if os.path.exists(PATIENT_DATA_CSV):
+            return self.get_data_values_array()
+
+        # Only the data set itself is available
+        return pd.read_csv("Machine Learning Data/patient_data_set.csv", index_col=DATA_SET_FIELDNAMES[0],
+                           dtype={DATA_SET_FIELDNAMES[0]: str})
+
+    def _get_source_files(self, source):
+        """
+        :param source: patient_data.csv or an export directory
+        :return: list of the files the data set is built from
+        """
+        if os.path.isdir(source):
+            paths = [os.path.join(source, file_name) for file_name in sorted(os.listdir(source))
+                     if file_name.endswith(".ndjson")]
+        else:
+            paths = [source, "Machine Learning Data/patient_ids.csv"]
+        return paths + ["Machine Learning Data/data_codes.csv"]
 
     def machine_learning_LR(self):
         """
@@ -233,7 +449,7 @@ class MachineLearningClient:
         """
 
         # Loading Data Set
-        data = pd.read_csv("Machine Learning Data/patient_data_set.csv")
+        data = self.load_data_set()
         data.head()
 
         # Exploratory Analysis
@@ -241,9 +457,10 @@ class MachineLearningClient:
         missing_data = data.isnull().sum()
         total_percentage = (missing_data.sum()/data.shape[0]) * 100
         print(f"the total percentage of missing data is {round(total_percentage, 2)}%")
+        data = data.fillna(0)  # missing values are 0, as in patient_data_set.csv
 
         # Prediction
-        X = data.drop(["PATIENT ID", "CHOLESTEROL"], 1)
+        X = data.drop(columns=["CHOLESTEROL"])
         # X = preprocessing.scale(X)
         y = data["CHOLESTEROL"]
 
@@ -285,6 +502,254 @@ class MachineLearningClient:
         print(df)
 
 
+def get_observation_value(resource, data_code):
+    """
+    Reads the value of an observation used by the machine learning data set.
+    :param resource: Observation resource
+    :param data_code: data code the observation was found for
+    :return: tuple of (diagnostic description, value), the systolic value for blood pressure and the
+    SNOMED code for smoking status
+    """
+    try:
+        data_description = resource["code"]["coding"][0]["display"]
+        data_value = resource["valueQuantity"]["value"]
+    except KeyError:
+
+        if data_code == "55284-4":  # Blood pressure
+            for component in resource.get("component", []):
+                if component["code"]["coding"][0]["code"] == "8480-6":  # Systolic Blood Pressure
+                    return component["code"]["coding"][0]["display"], component["valueQuantity"]["value"]
+
+        elif data_code == "72166-2" and "valueCodeableConcept" in resource:  # Smoking status
+            return resource["code"]["coding"][0]["display"], resource["valueCodeableConcept"]["coding"][0]["code"]
+
+        data_description = "No Data"
+        data_value = "0"
+
+    return data_description, data_value
+
+
+def pivot_patient_data(patient_data, data_codes):
+    """
+    Pivots the rows of patient_data.csv into the data set, with one row per patient and one column per data code.
+    Rows are matched to their data code with the DATA CODE column. Files written before that column existed have
+    one row per data code for each patient, in the order of the data codes, and are matched by position instead.
+    The values are scattered into a NumPy matrix by patient and data code index, without looping over the rows.
+    :param patient_data: DataFrame of patient_data.csv, with the patient ids and data codes read as text
+    :param data_codes: list of data codes, in the order of the data set columns
+    :return: DataFrame of float values indexed by patient id, with the data set columns. NaN where a patient has no
+    row or "No Data" for a data code
+    """
+    patient_codes, patient_ids = pd.factorize(patient_data["PATIENT ID"])
+    if "DATA CODE" in patient_data.columns:
+        code_indexes = pd.Index(data_codes).get_indexer(patient_data["DATA CODE"])
+    else:
+        code_indexes = pd.Series(patient_codes).groupby(patient_codes).cumcount().to_numpy() % len(data_codes)
+
+    values = pd.to_numeric(patient_data["VALUE"], errors="coerce").to_numpy(dtype=np.float64, copy=True)
+    values[(patient_data["DIAGNOSTIC DESCRIPTION"] == "No Data").to_numpy()] = np.nan
+
+    # Rows of data codes which are not in the data set are dropped. When a patient has several rows for a data code
+    # the last one wins, like a later harvest overwriting an earlier one
+    known = code_indexes >= 0
+    cells = patient_codes[known] * len(data_codes) + code_indexes[known]
+    _, last_rows = np.unique(cells[::-1], return_index=True)
+    last_rows = len(cells) - 1 - last_rows
+
+    data_values = np.full(len(patient_ids) * len(data_codes), np.nan)
+    data_values[cells[last_rows]] = values[known][last_rows]
+    return pd.DataFrame(data_values.reshape(len(patient_ids), len(data_codes)),
+                        index=pd.Index(patient_ids, name="PATIENT ID"),
+                        columns=DATA_SET_FIELDNAMES[1:len(data_codes) + 1])
+
+
+def hash_files(paths):
+    """
+    :param paths: list of file paths
+    :return: SHA-256 hex digest of the names and contents of the files, missing files included by name only
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode() + b"\0")
+        if os.path.exists(path):
+            with open(path, "rb") as source_file:
+                for chunk in iter(lambda: source_file.read(1 << 20), b""):
+                    digest.update(chunk)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def get_effective_time(resource):
+    """
+    :param resource: Observation resource
+    :return: POSIX timestamp of the observation's effective date, -inf if it has none. Dates without a time zone
+    are taken as UTC
+    """
+    effective_date = resource.get("effectiveDateTime", resource.get("issued"))
+    if effective_date is None:
+        return -math.inf
+    effective_date = parse_effective_date(effective_date)
+    if effective_date is None:
+        return -math.inf
+    if effective_date.tzinfo is None:
+        effective_date = effective_date.replace(tzinfo=timezone.utc)
+    return effective_date.timestamp()
+
+
+def read_ndjson(path):
+    """
+    Reads the resources of an NDJSON file one line at a time, so the whole file is never held in memory.
+    :param path: path of the NDJSON file
+    :return: generator of resources
+    """
+    with open(path, "r", encoding="utf-8") as ndjson_file:
+        for line in ndjson_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class HarvestCheckpoint:
+    """
+    Patient and data code pairs finished by a harvest, appended to a CSV file as they finish
+    Every row is flushed to disk straight away, so the pairs survive the harvest crashing or being stopped
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the checkpoint file
+        """
+        self._path = path
+        self._file = None
+        self._writer = None
+
+    def load(self):
+        """
+        Read the pairs saved by a previous harvest
+        :return: dictionary of (patient id, data code) -> (diagnostic description, value)
+        """
+        results = {}
+        if not os.path.exists(self._path):
+            return results
+        with open(self._path, "r", newline="") as checkpoint_file:
+            for row in csv.reader(checkpoint_file):
+                if len(row) == 4:  # the last row may be incomplete if the harvest was killed while writing it
+                    results[(row[0], row[1])] = (row[2], row[3])
+        return results
+
+    def add(self, pair, result):
+        """
+        Save a finished pair
+        :param pair: tuple of (patient id, data code)
+        :param result: tuple of (diagnostic description, value)
+        :return: None
+        """
+        if self._file is None:
+            self._file = open(self._path, "a", newline="")
+            self._writer = csv.writer(self._file)
+        self._writer.writerow(pair + tuple(result))
+        self._file.flush()
+
+    def close(self):
+        """
+        Close the checkpoint file, the saved pairs are kept
+        :return: None
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+
+    def clear(self):
+        """
+        Delete the checkpoint file, once the harvest has finished
+        :return: None
+        """
+        self.close()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DataSetCache:
+    """
+    Typed copy of the data set in an uncompressed .npz file, loaded instead of parsing patient_data_set.csv
+    The values are one float64 matrix (SNOMED codes are below 2 ** 53 so they are exact), read in a single block
+    and wrapped in a DataFrame without copying. The file also carries a hash of the source files the data set was
+    built from, to detect a stale cache, and a hash of its own arrays, to detect a damaged one
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the .npz file
+        """
+        self._path = path
+
+    def save(self, data_set, source, source_files):
+        """
+        Save the data set, replacing the previous cache in one step
+        :param data_set: DataFrame of data values indexed by patient id
+        :param source: patient_data.csv or the export directory the data set was built from
+        :param source_files: list of the files the data set was built from
+        :return: None
+        """
+        arrays = {"patient_ids": data_set.index.to_numpy(dtype=str),
+                  "columns": np.asarray(data_set.columns, dtype=str),
+                  "values": np.ascontiguousarray(data_set.to_numpy(dtype=np.float64))}
+        arrays["content_hash"] = np.asarray(_hash_arrays(arrays))
+        arrays["source"] = np.asarray(source)
+        arrays["source_hash"] = np.asarray(hash_files(source_files))
+
+        temporary_path = self._path + ".tmp"
+        with open(temporary_path, "wb") as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(temporary_path, self._path)
+
+    def get_source(self):
+        """
+        :return: patient_data.csv or the export directory the cached data set was built from, None if there is no
+        cache
+        """
+        try:
+            with np.load(self._path) as cache:
+                return str(cache["source"])
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+
+    def load(self, source_files):
+        """
+        Load the data set, if it is still up to date
+        :param source_files: current list of the files the data set is built from
+        :return: DataFrame of data values indexed by patient id, None if there is no cache, the source files changed
+        or the cache is damaged
+        """
+        try:
+            with np.load(self._path) as cache:
+                if str(cache["source_hash"]) != hash_files(source_files):
+                    return None
+                arrays = {name: cache[name] for name in ("patient_ids", "columns", "values")}
+                content_hash = str(cache["content_hash"])
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        if content_hash != _hash_arrays(arrays):
+            return None
+        return pd.DataFrame(arrays["values"], index=pd.Index(arrays["patient_ids"], dtype=object, name="PATIENT ID"),
+                            columns=arrays["columns"].tolist(), copy=False)
+
+
+def _hash_arrays(arrays):
+    """SHA-256 hex digest of the data set arrays, in a fixed order"""
+    digest = hashlib.sha256()
+    for name in ("patient_ids", "columns", "values"):
+        digest.update(name.encode() + str(arrays[name].dtype).encode() + str(arrays[name].shape).encode())
+        digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return digest.hexdigest()
+
+
 if __name__ == '__main__':
     client = MachineLearningClient("https://fhir.monash.edu/hapi-fhir-jpaserver/fhir/")
     # client.patient_id_csv()
@@ -292,5 +757,6 @@ if __name__ == '__main__':
     # print(client.read_data_csv())
     # print(client.data_chart())
     # print(client.get_data_values_array())
+    # client.export_data_set_csv()
     # print(client.set_data_values_array())
     print(client.machine_learning_LR())
@@ -0,0 +1,341 @@
+import functools
+import math
+import threading
+from datetime import datetime, timezone, timedelta
+import numpy as np
+from src.patientdata_module import CholesterolData, BloodPressureData
+
+NO_OFFSET = -32768  # time zone offset stored for effective dates without a time zone
+
+
+class ObservationStore:
+    """
+    Column storage for the latest observations of every patient
+    Each patient owns one row, values and effective dates are kept in NumPy arrays indexed by row so statistics,
+    limit checks and graph series over many patients are computed on whole columns. Missing values are NaN.
+    Effective dates are stored as POSIX timestamps with their time zone offset in minutes
+    """
+
+    BLOOD_PRESSURE_SLOTS = 5  # number of latest blood pressure observations kept per patient
+    COLUMNS = ("has_cholesterol", "cholesterol", "cholesterol_unit", "cholesterol_time", "cholesterol_offset",
+               "blood_pressure_count", "systolic", "diastolic", "blood_pressure_unit", "blood_pressure_time",
+               "blood_pressure_offset")
+
+    def __init__(self, capacity=256):
+        """
+        :param capacity: number of rows allocated up front, the columns double in size when full
+        """
+        self._lock = threading.Lock()
+        self._size = 0
+        self._released_rows = []  # rows of patients which no longer exist, reused by add_row
+        self._units = []  # unit index -> unit
+        self._unit_indexes = {}  # unit -> unit index
+        self._other_dates = {}  # (column name, position) -> effective date text which is not an ISO date
+        self._columns = {}
+        self._allocate(capacity)
+
+    @staticmethod
+    def _get_column_specs(capacity):
+        slots = ObservationStore.BLOOD_PRESSURE_SLOTS
+        return {
+            "has_cholesterol": ((capacity,), np.bool_, False),
+            "cholesterol": ((capacity,), np.float64, np.nan),
+            "cholesterol_unit": ((capacity,), np.int16, -1),
+            "cholesterol_time": ((capacity,), np.float64, np.nan),
+            "cholesterol_offset": ((capacity,), np.int16, NO_OFFSET),
+            "blood_pressure_count": ((capacity,), np.int8, -1),  # -1 until the patient's data is set
+            "systolic": ((capacity, slots), np.float64, np.nan),
+            "diastolic": ((capacity, slots), np.float64, np.nan),
+            "blood_pressure_unit": ((capacity, slots), np.int16, -1),
+            "blood_pressure_time": ((capacity, slots), np.float64, np.nan),
+            "blood_pressure_offset": ((capacity, slots), np.int16, NO_OFFSET),
+        }
+
+    def _allocate(self, capacity):
+        for name, (shape, dtype, fill) in self._get_column_specs(capacity).items():
+            column = np.full(shape, fill, dtype=dtype)
+            if name in self._columns:
+                column[:self._size] = self._columns[name][:self._size]
+            self._columns[name] = column
+
+    def add_row(self):
+        """
+        Allocate the row of a new patient, reusing a released row if there is one
+        :return: row index
+        """
+        with self._lock:
+            if len(self._released_rows) > 0:
+                row = self._released_rows.pop()
+                self._clear_row(row)
+                return row
+            if self._size == len(self._columns["cholesterol"]):
+                self._allocate(2 * self._size)
+            row = self._size
+            self._size += 1
+            return row
+
+    def release_row(self, row):
+        """
+        Give back the row of a patient which is no longer used, it is reused by a later add_row
+        :param row: patient's row
+        :return: None
+        """
+        with self._lock:
+            self._released_rows.append(row)
+
+    def __len__(self):
+        """
+        :return: number of rows in use
+        """
+        with self._lock:
+            return self._size - len(self._released_rows)
+
+    def _clear_row(self, row):
+        for name, (_, _, fill) in self._get_column_specs(0).items():
+            self._columns[name][row] = fill
+        if len(self._other_dates) > 0:
+            for key in [key for key in self._other_dates if key[1] == row]:
+                del self._other_dates[key]
+
+    def set_cholesterol(self, row, data):
+        """
+        Store the patient's latest cholesterol observation
+        :param row: patient's row
+        :param data: CholesterolData object, None to clear it
+        :return: None
+        """
+        with self._lock:
+            columns = self._columns
+            if data is None:
+                columns["has_cholesterol"][row] = False
+                columns["cholesterol"][row] = np.nan
+                return
+            value, unit, _ = data.get_data()
+            effective_date = data.get_effective_date()
+            columns["has_cholesterol"][row] = True
+            columns["cholesterol"][row] = _to_number(value)
+            columns["cholesterol_unit"][row] = self._unit_index(unit)
+            columns["cholesterol_time"][row], columns["cholesterol_offset"][row] = \
+                self._to_timestamp(effective_date, ("cholesterol", row))
+
+    def get_cholesterol(self, row):
+        """
+        :param row: patient's row
+        :return: CholesterolData object, None if the patient's data was never set
+        """
+        columns = self._columns
+        if not columns["has_cholesterol"][row]:
+            return None
+        return CholesterolData(_from_number(columns["cholesterol"][row]), self._units[columns["cholesterol_unit"][row]],
+                               self._from_timestamp(columns["cholesterol_time"][row],
+                                                    columns["cholesterol_offset"][row], ("cholesterol", row)))
+
+    def set_blood_pressure(self, row, data):
+        """
+        Store the patient's latest blood pressure observations, only the first BLOOD_PRESSURE_SLOTS are kept
+        :param row: patient's row
+        :param data: list of BloodPressureData objects, latest first, None to clear it
+        :return: None
+        """
+        with self._lock:
+            columns = self._columns
+            columns["systolic"][row] = np.nan
+            columns["diastolic"][row] = np.nan
+            if data is None:
+                columns["blood_pressure_count"][row] = -1
+                return
+            data = data[:ObservationStore.BLOOD_PRESSURE_SLOTS]
+            columns["blood_pressure_count"][row] = len(data)
+            for slot, observation in enumerate(data):
+                systolic, diastolic, unit, _ = observation.get_data()
+                effective_date = observation.get_effective_date()
+                columns["systolic"][row, slot] = _to_number(systolic)
+                columns["diastolic"][row, slot] = _to_number(diastolic)
+                columns["blood_pressure_unit"][row, slot] = self._unit_index(unit)
+                columns["blood_pressure_time"][row, slot], columns["blood_pressure_offset"][row, slot] = \
+                    self._to_timestamp(effective_date, ("blood_pressure", row, slot))
+
+    def get_blood_pressure(self, row):
+        """
+        :param row: patient's row
+        :return: list of BloodPressureData objects, latest first, None if the patient's data was never set
+        """
+        columns = self._columns
+        count = columns["blood_pressure_count"][row]
+        if count < 0:
+            return None
+        return [self.get_blood_pressure_observation(row, slot) for slot in range(count)]
+
+    def get_blood_pressure_observation(self, row, slot):
+        """
+        :param row: patient's row
+        :param slot: 0 for the latest observation, 1 for the one before...
+        :return: BloodPressureData object
+        """
+        columns = self._columns
+        if slot < 0 or slot >= columns["blood_pressure_count"][row]:
+            raise IndexError("blood pressure observation out of range")
+        return BloodPressureData(_from_number(columns["systolic"][row, slot]),
+                                 _from_number(columns["diastolic"][row, slot]),
+                                 self._units[columns["blood_pressure_unit"][row, slot]],
+                                 self._from_timestamp(columns["blood_pressure_time"][row, slot],
+                                                      columns["blood_pressure_offset"][row, slot],
+                                                      ("blood_pressure", row, slot)))
+
+    def get_row(self, row):
+        """
+        Raw values of a row, used to pickle a patient without building data objects
+        :param row: patient's row
+        :return: tuple of the row's value in each column, units as text, and its effective dates which are not dates
+        """
+        columns = self._columns
+        values = [columns[name][row].tolist() for name in ObservationStore.COLUMNS]
+        units = self._units + [None]  # unit index -1 is never set
+        values[ObservationStore.COLUMNS.index("cholesterol_unit")] = units[columns["cholesterol_unit"][row]]
+        values[ObservationStore.COLUMNS.index("blood_pressure_unit")] = [
+            units[index] for index in columns["blood_pressure_unit"][row].tolist()]
+        other_dates = {(key[0],) + key[2:]: text for key, text in self._other_dates.items() if key[1] == row} \
+            if len(self._other_dates) > 0 else {}
+        return tuple(values), other_dates
+
+    def set_row(self, row, state):
+        """
+        Restore the values of a row returned by get_row
+        :param row: patient's row
+        :param state: value returned by get_row
+        :return: None
+        """
+        values, other_dates = state
+        values = list(values)
+        with self._lock:
+            values[ObservationStore.COLUMNS.index("cholesterol_unit")] = \
+                self._unit_index(values[ObservationStore.COLUMNS.index("cholesterol_unit")])
+            values[ObservationStore.COLUMNS.index("blood_pressure_unit")] = [
+                self._unit_index(unit) for unit in values[ObservationStore.COLUMNS.index("blood_pressure_unit")]]
+            for name, value in zip(ObservationStore.COLUMNS, values):
+                self._columns[name][row] = value
+            for key, text in other_dates.items():
+                self._other_dates[(key[0], row) + key[1:]] = text
+
+    def get_cholesterol_value(self, row):
+        """
+        :param row: patient's row
+        :return: latest cholesterol value as a float, None if there is no value
+        """
+        return _from_float(self._columns["cholesterol"][row])
+
+    def get_cholesterol_date(self, row):
+        """
+        :param row: patient's row
+        :return: datetime of the latest cholesterol observation, None if there is no date
+        """
+        columns = self._columns
+        return self._to_datetime(columns["cholesterol_time"][row], columns["cholesterol_offset"][row])
+
+    def get_blood_pressure_value(self, row, slot=0):
+        """
+        :param row: patient's row
+        :param slot: 0 for the latest observation, 1 for the one before...
+        :return: tuple of systolic and diastolic values as floats, None where there is no value
+        """
+        columns = self._columns
+        if slot >= columns["blood_pressure_count"][row]:
+            return None, None
+        return _from_float(columns["systolic"][row, slot]), _from_float(columns["diastolic"][row, slot])
+
+    def get_blood_pressure_date(self, row, slot=0):
+        """
+        :param row: patient's row
+        :param slot: 0 for the latest observation, 1 for the one before...
+        :return: datetime of the blood pressure observation, None if there is no date
+        """
+        columns = self._columns
+        if slot >= columns["blood_pressure_count"][row]:
+            return None
+        return self._to_datetime(columns["blood_pressure_time"][row, slot], columns["blood_pressure_offset"][row, slot])
+
+    def get_cholesterol_values(self, rows):
+        """
+        :param rows: array of patient rows
+        :return: array of the patients' latest cholesterol values, NaN where there is no value
+        """
+        return self._columns["cholesterol"][rows]
+
+    def get_blood_pressure_values(self, rows, slot=0):
+        """
+        :param rows: array of patient rows
+        :param slot: 0 for the latest observations, 1 for the ones before...
+        :return: tuple of arrays of systolic and diastolic values, NaN where there is no value
+        """
+        return self._columns["systolic"][rows, slot], self._columns["diastolic"][rows, slot]
+
+    def get_systolic_history(self, rows):
+        """
+        :param rows: array of patient rows
+        :return: 2D array of the latest systolic values of each patient, latest first, NaN where there is no value
+        """
+        return self._columns["systolic"][rows]
+
+    def _unit_index(self, unit):
+        index = self._unit_indexes.get(unit)
+        if index is None:
+            index = len(self._units)
+            self._units.append(unit)
+            self._unit_indexes[unit] = index
+        return index
+
+    def _to_timestamp(self, effective_date, key):
+        self._other_dates.pop(key, None)
+        if not isinstance(effective_date, datetime):
+            # Placeholders other than "-" are kept as they are
+            if effective_date != "-":
+                self._other_dates[key] = effective_date
+            return np.nan, NO_OFFSET
+        if effective_date.tzinfo is None:
+            return effective_date.replace(tzinfo=timezone.utc).timestamp(), NO_OFFSET
+        return effective_date.timestamp(), int(effective_date.utcoffset().total_seconds() // 60)
+
+    def _from_timestamp(self, timestamp, offset, key):
+        if math.isnan(timestamp):
+            return self._other_dates.get(key, "-")
+        return self._to_datetime(timestamp, offset)
+
+    @staticmethod
+    def _to_datetime(timestamp, offset):
+        if math.isnan(timestamp):
+            return None
+        if offset == NO_OFFSET:
+            return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+        return datetime.fromtimestamp(timestamp, _time_zone(int(offset)))
+
+
+@functools.lru_cache(maxsize=None)
+def _time_zone(offset):
+    """Time zone with the given offset in minutes, shared by every date with that offset"""
+    return timezone(timedelta(minutes=offset))
+
+
+def _to_number(value):
+    """Convert an observation value to a float, NaN for placeholders such as "-" """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return np.nan
+
+
+def _from_float(value):
+    """Convert a stored float to a Python float, None for NaN"""
+    if math.isnan(value):
+        return None
+    return float(value)
+
+
+def _from_number(value):
+    """Convert a stored float back to an observation value, whole numbers become ints and NaN becomes "-" """
+    if math.isnan(value):
+        return "-"
+    if float(value).is_integer():
+        return int(value)
+    return float(value)
+
+
+default_store = ObservationStore()  # store used by patients created without one
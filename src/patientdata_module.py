@@ -1,7 +1,13 @@
+import functools
+import re
+import sys
 from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
 
 
 class PatientData(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def get_data(self):
         pass
@@ -10,34 +16,207 @@ class PatientData(ABC):
     def set_data(self, data):
         pass
 
+    def get_effective_date(self):
+        """
+        :return: datetime of the observation, or the text given for it if it is not an ISO date (e.g. "-")
+        """
+        return self._effective_date
+
+    def __reduce__(self):
+        return self.__class__, self.get_data()
+
+    def __setstate__(self, state):
+        # Objects pickled before __slots__ was added have a dictionary of attributes
+        if isinstance(state, dict):
+            state = tuple(state.get(name) for name in self.__slots__)
+        self.set_data(state)
+
 
 class CholesterolData(PatientData):
+    __slots__ = ("_value", "_unit", "_effective_date")
+
     def __init__(self, value, unit, effective_date):
-        self._value = value
-        self._unit = unit
-        self._effective_date = effective_date
+        self.set_data((value, unit, effective_date))
 
     def get_data(self):
-        return self._value, self._unit, self._effective_date
+        return self._value, self._unit, _format_date(self._effective_date)
 
     def set_data(self, data):
-        self._value = data(0)
-        self._unit = data(1)
-        self._effective_date = data(2)
+        self._value = data[0]
+        self._unit = _intern(data[1])
+        self._effective_date = _parse_date(data[2])
 
 
 class BloodPressureData(PatientData):
+    __slots__ = ("_systolic", "_diastolic", "_unit", "_effective_date")
+
     def __init__(self, systolic, diastolic, unit, effective_date):
-        self._systolic = systolic
-        self._diastolic = diastolic
-        self._unit = unit
-        self._effective_date = effective_date
+        self.set_data((systolic, diastolic, unit, effective_date))
 
     def get_data(self):
-        return self._systolic, self._diastolic, self._unit, self._effective_date
+        return self._systolic, self._diastolic, self._unit, _format_date(self._effective_date)
 
     def set_data(self, data):
-        self._systolic = data(0)
-        self._diastolic = data(1)
-        self._unit = data(2)
-        self._effective_date = data(3)
+        self._systolic = data[0]
+        self._diastolic = data[1]
+        self._unit = _intern(data[2])
+        self._effective_date = _parse_date(data[3])
+
+
+def _intern(text):
+    """Share one copy of repeated strings such as units between all observations"""
+    if isinstance(text, str):
+        return sys.intern(text)
+    return text
+
+
+# FHIR dateTime: a year, optionally followed by the month, the day, the time and the time zone
+_DATE_TIME = re.compile(r"(\d{4})(?:-(\d{2})(?:-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?"
+                        r"(Z|[+-]\d{2}:?\d{2})?)?)?)?")
+
+
+def parse_effective_date(effective_date):
+    """
+    Parse the effective date of an observation. Besides what datetime.fromisoformat reads, this accepts the "Z"
+    time zone, partial dates such as "2019-03" or "2019", which are taken as their first day, and fractions of
+    seconds of any length
+    :param effective_date: FHIR dateTime text
+    :return: datetime, with a time zone if the text has one, None if the text is not a date
+    """
+    try:
+        return datetime.fromisoformat(effective_date)
+    except ValueError:
+        pass
+    except TypeError:
+        return None
+
+    match = _DATE_TIME.fullmatch(effective_date.strip())
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    try:
+        date_time = datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0),
+                             int(second or 0), int((fraction or "0")[:6].ljust(6, "0")))
+        if zone is None:
+            return date_time
+        if zone == "Z":
+            return date_time.replace(tzinfo=timezone.utc)
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[-2:]))
+        return date_time.replace(tzinfo=_time_zone(offset if zone[0] == "+" else -offset))
+    except ValueError:  # e.g. month 13 or an offset of 24 hours or more
+        return None
+
+
+def _parse_date(effective_date):
+    """Parse an ISO effective date once, text which is not a date (e.g. "-") is kept as it is"""
+    if isinstance(effective_date, str):
+        parsed_date = parse_effective_date(effective_date)
+        if parsed_date is None:
+            return _intern(effective_date)
+        effective_date = parsed_date
+    if isinstance(effective_date, datetime) and effective_date.tzinfo is not None:
+        effective_date = effective_date.replace(tzinfo=_time_zone(effective_date.utcoffset()))
+    return effective_date
+
+
+@functools.lru_cache(maxsize=None)
+def _time_zone(offset):
+    """Time zone with the given offset, shared by every date with that offset"""
+    return timezone(offset)
+
+
+def _format_date(effective_date):
+    if isinstance(effective_date, datetime):
+        return effective_date.isoformat()
+    return effective_date
+
+
+class RunningStatistics:
+    """
+    Count, mean, variance, minimum and maximum of a collection of values which changes over time
+    Adding or removing a value is O(1), the minimum and maximum are only recalculated after an extreme value is removed
+    The mean and the sum of squared differences from it are kept with Welford's update, a removal applies the
+    reverse update, so the variance of close values such as cholesterol levels does not lose its precision
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._mean = 0
+        self._squared_differences = 0  # sum of the squared differences from the mean
+        self._value_counts = {}  # value -> number of times it was added
+        self._minimum = None
+        self._maximum = None
+
+    def __setstate__(self, state):
+        # Statistics pickled before Welford's update kept the total and the total of the squares
+        state = dict(state)
+        total = state.pop("_total", None)
+        total_squares = state.pop("_total_squares", None)
+        self.__dict__.update(state)
+        if total is not None:
+            self._mean = total / self.count if self.count > 0 else 0
+            self._squared_differences = max(total_squares - total * self._mean, 0) if self.count > 0 else 0
+
+    def add(self, value):
+        self.count += 1
+        difference = value - self._mean
+        self._mean += difference / self.count
+        self._squared_differences += difference * (value - self._mean)
+        self._value_counts[value] = self._value_counts.get(value, 0) + 1
+        if self._minimum is not None and value < self._minimum:
+            self._minimum = value
+        if self._maximum is not None and value > self._maximum:
+            self._maximum = value
+        if self.count == 1:
+            self._minimum = self._maximum = value
+
+    def remove(self, value):
+        self.count -= 1
+        self._value_counts[value] -= 1
+        if self._value_counts[value] == 0:
+            del self._value_counts[value]
+            # The extremes are recalculated when next requested
+            if value == self._minimum:
+                self._minimum = None
+            if value == self._maximum:
+                self._maximum = None
+
+        if self.count <= 1:
+            # Start again from the exact values instead of accumulated rounding errors
+            self._mean = next(iter(self._value_counts), 0)
+            self._squared_differences = 0
+        else:
+            previous_mean = self._mean
+            self._mean -= (value - previous_mean) / self.count
+            self._squared_differences = max(self._squared_differences - (value - previous_mean) * (value - self._mean),
+                                            0)
+
+    def get_mean(self):
+        """
+        :return: mean of the values, 0 if there are none
+        """
+        return self._mean
+
+    def get_variance(self):
+        """
+        :return: population variance of the values, 0 if there are none
+        """
+        if self.count == 0:
+            return 0
+        return self._squared_differences / self.count
+
+    def get_min(self):
+        """
+        :return: smallest value, None if there are none
+        """
+        if self._minimum is None and self.count > 0:
+            self._minimum = min(self._value_counts)
+        return self._minimum
+
+    def get_max(self):
+        """
+        :return: largest value, None if there are none
+        """
+        if self._maximum is None and self.count > 0:
+            self._maximum = max(self._value_counts)
+        return self._maximum
@@ -1,24 +1,102 @@
-from src.patientdata_module import CholesterolData, BloodPressureData
+from src.patientdata_module import CholesterolData, BloodPressureData, RunningStatistics
+from src import observation_module
+from src.event_module import CHOLESTEROL, BLOOD_PRESSURE, MEMBERSHIP, DATA_CHANGES
+import numpy as np
+import sys
+import threading
 import tkinter as tk
 
 
 class Person:
+    __slots__ = ("first_name", "last_name", "id")
+
     def __init__(self, first_name, last_name, person_id):
         self.first_name = first_name
         self.last_name = last_name
         self.id = person_id
 
+    def __setstate__(self, state):
+        _set_state(self, state)
+
 
 class Patient(Person):
+    __slots__ = ("birth_date", "gender", "address", "_observation_store", "row")
+
     def __init__(self, first_name, last_name, person_id, birth_date, gender, address,
-                 cholesterol_data=None, blood_pressure_data=None):
+                 cholesterol_data=None, blood_pressure_data=None, observation_store=None):
         super().__init__(first_name, last_name, person_id)
         self.birth_date = birth_date
-        self.gender = gender
+        self.gender = sys.intern(gender)
         self.address = address
+
+        # The patient's observations are kept in a row of the observation store, until release_row is called
+        if observation_store is None:
+            observation_store = observation_module.default_store
+        self._observation_store = observation_store
+        self.row = self._observation_store.add_row()
         self.cholesterol_data = cholesterol_data
         self.blood_pressure_data = blood_pressure_data
 
+    def __getstate__(self):
+        # The observations are pickled with the patient rather than as a row of a store
+        return {"first_name": self.first_name, "last_name": self.last_name, "id": self.id,
+                "birth_date": self.birth_date, "gender": self.gender, "address": self.address,
+                "observations": self._observation_store.get_row(self.row)}
+
+    def __setstate__(self, state):
+        state = dict(state)
+        observations = state.pop("observations", None)
+        # Patients pickled before the observation store have their data objects instead
+        cholesterol_data = state.pop("cholesterol_data", None)
+        blood_pressure_data = state.pop("blood_pressure_data", None)
+        _set_state(self, state)
+        self._observation_store = observation_module.default_store
+        self.row = self._observation_store.add_row()
+        if observations is not None:
+            self._observation_store.set_row(self.row, observations)
+        else:
+            self.cholesterol_data = cholesterol_data
+            self.blood_pressure_data = blood_pressure_data
+
+    def release_row(self):
+        """
+        Give the patient's row back to the observation store, once the patient is no longer used anywhere
+        The patient's data can not be read or set afterwards
+        :return: None
+        """
+        if self.row is not None:
+            self._observation_store.release_row(self.row)
+            self.row = None
+
+    @property
+    def observation_store(self):
+        """
+        :return: ObservationStore holding the patient's observations in its row
+        """
+        return self._observation_store
+
+    @property
+    def cholesterol_data(self):
+        """
+        :return: CholesterolData object read from the observation store, None if the patient has no data
+        """
+        return self._observation_store.get_cholesterol(self.row)
+
+    @cholesterol_data.setter
+    def cholesterol_data(self, data):
+        self._observation_store.set_cholesterol(self.row, data)
+
+    @property
+    def blood_pressure_data(self):
+        """
+        :return: list of BloodPressureData objects read from the observation store, None if the patient has no data
+        """
+        return self._observation_store.get_blood_pressure(self.row)
+
+    @blood_pressure_data.setter
+    def blood_pressure_data(self, data):
+        self._observation_store.set_blood_pressure(self.row, data)
+
     def get_address(self):
         """
         Formats and returns patient's address
@@ -27,22 +105,69 @@ class Patient(Person):
         return self.address.line[0]+", "+self.address.city+", "+self.address.state+", "+self.address.country
 
     def update_data(self, data):
-        if isinstance(data, CholesterolData):
+        """
+        Store new patient data
+        :param data: CholesterolData object, list of BloodPressureData objects, or a tuple of both
+        :return: set of the kinds of data which changed, CHOLESTEROL and/or BLOOD_PRESSURE
+        """
+        changes = set()
+        if isinstance(data, tuple):  # Several data types requested together
+            for patient_data in data:
+                changes.update(self.update_data(patient_data))
+        elif isinstance(data, CholesterolData):
+            old_data = (self.get_cholesterol_value(), self.get_cholesterol_date())
             self.cholesterol_data = data
+            if (self.get_cholesterol_value(), self.get_cholesterol_date()) != old_data:
+                changes.add(CHOLESTEROL)
         else:
+            old_data = self._get_blood_pressure_history()
             self.blood_pressure_data = data
-        return
+            if self._get_blood_pressure_history() != old_data:
+                changes.add(BLOOD_PRESSURE)
+        return changes
+
+    def _get_blood_pressure_history(self):
+        return tuple((self.get_blood_pressure_value(i), self.get_blood_pressure_date(i))
+                     for i in range(observation_module.ObservationStore.BLOOD_PRESSURE_SLOTS))
 
     def get_cholesterol_data(self):
         return self.cholesterol_data.get_data()
 
     def get_blood_pressure_data(self, index):
-        return self.blood_pressure_data[index].get_data()
+        return self._observation_store.get_blood_pressure_observation(self.row, index).get_data()
+
+    def get_cholesterol_value(self):
+        """
+        :return: latest cholesterol value as a float, None if there is no value
+        """
+        return self._observation_store.get_cholesterol_value(self.row)
+
+    def get_cholesterol_date(self):
+        """
+        :return: datetime of the latest cholesterol observation, None if there is none
+        """
+        return self._observation_store.get_cholesterol_date(self.row)
+
+    def get_blood_pressure_value(self, index=0):
+        """
+        :param index: 0 for the latest observation, 1 for the one before...
+        :return: tuple of systolic and diastolic values as floats, None where there is no value
+        """
+        return self._observation_store.get_blood_pressure_value(self.row, index)
+
+    def get_blood_pressure_date(self, index=0):
+        """
+        :param index: 0 for the latest observation, 1 for the one before...
+        :return: datetime of the blood pressure observation, None if there is none
+        """
+        return self._observation_store.get_blood_pressure_date(self.row, index)
 
 
 class HealthPractitioner(Person):
     def __init__(self, first_name, last_name, practitioner_id, patient_list=None):
         super().__init__(first_name, last_name, practitioner_id)
+        if patient_list is None:
+            patient_list = PatientList()
         self._patient_list = patient_list
         self._monitored_patients = PatientList()
 
@@ -57,12 +182,39 @@ class HealthPractitioner(Person):
     def get_patient_data(self, client):
         """
         For each patient in the practitioner's monitored patient list, retrieve their data from the server
+        The data of all monitored patients is requested in batches, only patients with new observations are updated
         :param client: FHIR Client
-        :return: None
+        :return: list of the patients whose data was updated
+        """
+        updated_patients = []
+        for patient, patient_data in self.request_patient_data(client):
+            self.update_patient_data(patient, patient_data)
+            updated_patients.append(patient)
+        return updated_patients
+
+    def request_patient_data(self, client, cancelled=None):
         """
-        for patient in self._monitored_patients.get_patient_list():
-            # print("Requesting data for " + patient.first_name+" "+patient.last_name+"...")
-            patient.update_data(client.get_patient_data(patient.id))
+        Request the new data of the monitored patients without applying it, so it can be applied on another thread
+        :param client: FHIR Client
+        :param cancelled: optional threading.Event, once it is set no further request is sent
+        :return: list of (patient, patient data) for the patients with new observations
+        """
+        patients = list(self._monitored_patients.get_patient_list())
+        patient_data = client.get_new_patients_data([patient.id for patient in patients], cancelled=cancelled)
+        return [(patient, patient_data[str(patient.id)]) for patient in patients if str(patient.id) in patient_data]
+
+    def update_patient_data(self, patient, patient_data):
+        """
+        Apply new data to a patient and update the lists they are in
+        :param patient: Patient object
+        :param patient_data: patient data object(s) returned by a FHIR Client
+        :return: set of the kinds of data which changed, CHOLESTEROL and/or BLOOD_PRESSURE
+        """
+        changes = patient.update_data(patient_data)
+        if len(changes) > 0:
+            self._monitored_patients.update_patient(patient, changes)
+            self._patient_list.update_patient(patient, changes)
+        return changes
 
     def get_all_patients(self):
         """
@@ -76,23 +228,33 @@ class HealthPractitioner(Person):
         """
         return self._monitored_patients
 
-    def add_patient_monitor(self, patient_name):
+    def add_patient_monitor(self, patient_id):
         """
         Add patient to the monitor list from the all patients list
-        :param patient_name: full name of patient to be added
+        :param patient_id: id of the patient to be added
         :return: None
         """
-        for patient in self._patient_list.get_patient_list():
-            if patient_name == patient.first_name + " " + patient.last_name:
-                self._monitored_patients.add_patient(patient)
+        patient = self._patient_list.get_patient(patient_id)
+        if patient is not None:
+            self._monitored_patients.add_patient(patient)
 
-    def remove_patient_monitor(self, patient_name):
+    def remove_patient_monitor(self, patient_id):
         """
         Remove patient from monitor list
-        :param patient_name: full name of patient to be removed
+        :param patient_id: id of the patient to be removed
         :return: None
         """
-        self._monitored_patients.remove_patient(patient_name)
+        self._monitored_patients.remove_patient(patient_id)
+
+    def remove_patient(self, patient_id):
+        """
+        Remove patient from the monitor list and the all patients list, which owns the patients, and release their
+        row of the observation store
+        :param patient_id: id of the patient to be removed
+        :return: True if a patient was removed, False otherwise
+        """
+        self._monitored_patients.remove_patient(patient_id)
+        return self._patient_list.remove_patient(patient_id, release_row=True)
 
     def clear_monitor(self):
         """
@@ -103,62 +265,207 @@ class HealthPractitioner(Person):
 
 
 class PatientList:
+    DATA_TYPES = ("cholesterol", "systolic", "diastolic")  # data types with statistics
 
     def __init__(self):
-        self._patient_list = []
+        self._patients = {}  # patient id -> patient, in insertion order
+        self._patients_by_name = {}  # full name -> {patient id -> patient}, in insertion order
+        self._patient_list = None  # list of patients returned by get_patient_list, rebuilt after a change
+        self._rows = None  # observation store rows of the patients in get_patient_list order, rebuilt after a change
+        self._statistics = {data_type: RunningStatistics() for data_type in PatientList.DATA_TYPES}
+        self._patient_values = {}  # patient id -> {data type -> value included in the statistics}
+        self._lock = threading.RLock()
         self.average_cholesterol_level = 0
+        self._observers = []  # list of (observer, kinds of change it is notified of)
+        self._changes = {}  # patient id -> kinds of change not yet sent to the observers
+
+    def __setstate__(self, state):
+        # Patient lists pickled before the indexes were added only have the list of patients
+        patients = state.pop("_patient_list", None) or []
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        if "_patients" not in state:
+            self._patients = {}
+            self._patients_by_name = {}
+            self._statistics = {data_type: RunningStatistics() for data_type in PatientList.DATA_TYPES}
+            self._patient_values = {}
+            for patient in patients:
+                self._index_patient(patient)
+                self._count_patient(patient)
+            self.average_cholesterol_level = self._statistics["cholesterol"].get_mean()
+        self._patient_list = None
+        self._rows = None
         self._observers = []
+        self._changes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_patient_list"] = None
+        state["_rows"] = None
+        state["_observers"] = []  # widgets are not saved
+        state["_changes"] = {}
+        del state["_lock"]
+        return state
 
     def __len__(self):
-        return len(self._patient_list)
+        return len(self._patients)
 
     def __contains__(self, patient):
-        for i in range(len(self)):
-            current_patient = self._patient_list[i]
-            if current_patient.first_name == patient.first_name and current_patient.last_name == patient.last_name:
-                return True
-        return False
+        return patient.id in self._patients
 
     def __str__(self):
-        length = len(self)
-        if length > 0:
-            output = str(self._patient_list[length - 1])
-            for i in range(length - 2, -1, -1):
-                output += "," + str(self._patient_list[i])
-        else:
-            output = ""
-        return output
+        patients = self.get_patient_list()
+        return ",".join(str(patient) for patient in reversed(patients))
+
+    def _index_patient(self, patient):
+        self._patients[patient.id] = patient
+        self._patients_by_name.setdefault(patient.first_name + " " + patient.last_name, {})[patient.id] = patient
 
     def add_patient(self, patient):
         """
         Add the patient to the patient list and recalculate avg cholesterol
+        A patient whose id is already in the list is not added again
         :param patient: Patient Object
         :return: None
         """
-        if isinstance(patient, Patient):
-            self._patient_list.append(patient)
+        if isinstance(patient, Patient) and patient.id not in self._patients:
+            with self._lock:
+                self._index_patient(patient)
+                self._count_patient(patient)
+                self._patient_list = None
+                self._rows = None
+                self._add_change(patient.id, {MEMBERSHIP})
+                self.calculate_avg_cholesterol()
+
+    def remove_patient(self, patient_id, release_row=False):
+        """
+        Remove patient with the given id
+        :param patient_id: id of the patient to be removed
+        :param release_row: also release the patient's row of the observation store, only for a list which owns its
+        patients: the patient must not be in any other list
+        :return: True if a patient was removed, False otherwise
+        """
+        with self._lock:
+            selected_patient = self._patients.pop(patient_id, None)
+            if selected_patient is None:
+                return False
+            patient_name = selected_patient.first_name + " " + selected_patient.last_name
+            patients_with_name = self._patients_by_name[patient_name]
+            del patients_with_name[selected_patient.id]
+            if len(patients_with_name) == 0:
+                del self._patients_by_name[patient_name]
+            self._uncount_patient(selected_patient.id)
+            self._patient_list = None
+            self._rows = None
+            self._add_change(selected_patient.id, {MEMBERSHIP})
             self.calculate_avg_cholesterol()
+        if release_row:
+            selected_patient.release_row()
+        return True
 
-    def remove_patient(self, patient_name):
+    def update_patient(self, patient, changes=DATA_CHANGES):
         """
-        Remove patient with the given name
-        :param patient_name: Full name of the patient to be removed
+        Update the statistics after the patient's data changed, the change is sent to the observers on the next notify
+        :param patient: Patient Object
+        :param changes: kinds of data which changed, CHOLESTEROL and/or BLOOD_PRESSURE
         :return: None
         """
-        for i in range(len(self)):
-            selected_patient = self._patient_list[i]
-            if patient_name == selected_patient.first_name + " " + selected_patient.last_name:
-                self._patient_list.pop(i)
+        with self._lock:
+            if patient.id in self._patients:
+                self._uncount_patient(patient.id)
+                self._count_patient(patient)
+                self._add_change(patient.id, changes)
                 self.calculate_avg_cholesterol()
-                return True
-        return False
+
+    def _add_change(self, patient_id, changes):
+        # Changes are only kept while someone observes the list
+        if len(self._observers) > 0:
+            self._changes.setdefault(patient_id, set()).update(changes)
+
+    def _count_patient(self, patient):
+        systolic, diastolic = patient.get_blood_pressure_value(0)  # Latest observation at index 0
+        values = {"cholesterol": patient.get_cholesterol_value(), "systolic": systolic, "diastolic": diastolic}
+
+        # Patients without an observation have no value
+        values = {data_type: value for data_type, value in values.items() if value is not None}
+        for data_type, value in values.items():
+            self._statistics[data_type].add(value)
+        self._patient_values[patient.id] = values
+
+    def _uncount_patient(self, patient_id):
+        for data_type, value in self._patient_values.pop(patient_id, {}).items():
+            self._statistics[data_type].remove(value)
 
     def get_patient_list(self):
         """
         Getter method for the list of patients
         :return: array of patients
         """
-        return self._patient_list
+        # Also called from refresh workers while the Tk thread adds or removes patients
+        with self._lock:
+            if self._patient_list is None:
+                self._patient_list = list(self._patients.values())
+            return self._patient_list
+
+    def _get_rows(self):
+        """
+        :return: tuple of (array of the patients' rows in get_patient_list order,
+        list of (observation store, positions in get_patient_list of the patients with rows in that store))
+        """
+        with self._lock:
+            if self._rows is None:
+                patients = self.get_patient_list()
+                stores = {}  # id of store -> (store, positions)
+                for position, patient in enumerate(patients):
+                    store = patient.observation_store
+                    stores.setdefault(id(store), (store, []))[1].append(position)
+                groups = [(store, np.array(positions, dtype=np.intp)) for store, positions in stores.values()]
+                self._rows = (np.array([patient.row for patient in patients], dtype=np.intp), groups)
+            return self._rows
+
+    def _read_columns(self, read):
+        """
+        Read the patients' rows from their observation store
+        :param read: function of (observation store, rows) returning an array, or a tuple of arrays, with one entry
+        per row
+        :return: value returned by read, in get_patient_list order
+        """
+        rows, groups = self._get_rows()
+        if len(groups) == 0:
+            return read(observation_module.default_store, rows)
+        if len(groups) == 1:  # Usually every patient is in the same store
+            return read(groups[0][0], rows)
+
+        # Patients from several stores are read store by store, then put back in list order
+        results = [read(store, rows[positions]) for store, positions in groups]
+        combined = []
+        for parts in zip(*[result if isinstance(result, tuple) else (result,) for result in results]):
+            column = np.empty((len(rows),) + parts[0].shape[1:], dtype=parts[0].dtype)
+            for (_, positions), part in zip(groups, parts):
+                column[positions] = part
+            combined.append(column)
+        return tuple(combined) if isinstance(results[0], tuple) else combined[0]
+
+    def get_cholesterol_values(self):
+        """
+        Latest cholesterol values of the patients, read as one column from the observation store
+        :return: array of values in get_patient_list order, NaN for patients without a value
+        """
+        return self._read_columns(lambda store, rows: store.get_cholesterol_values(rows))
+
+    def get_blood_pressure_values(self, index=0):
+        """
+        Blood pressure values of the patients, read as columns from the observation store
+        :param index: 0 for the latest observations, 1 for the ones before...
+        :return: tuple of arrays of systolic and diastolic values in get_patient_list order, NaN where there is no value
+        """
+        return self._read_columns(lambda store, rows: store.get_blood_pressure_values(rows, index))
+
+    def get_systolic_history(self):
+        """
+        :return: 2D array of each patient's latest systolic values, latest first, NaN where there is no value
+        """
+        return self._read_columns(lambda store, rows: store.get_systolic_history(rows))
 
     def select_patient(self, patient_name):
         """
@@ -166,11 +473,18 @@ class PatientList:
         :param patient_name: name of the patient
         :return: Patient object if matching patient found, None otherwise
         """
-        for i in range(len(self)):
-            selected_patient = self._patient_list[i]
-            if patient_name == selected_patient.first_name + " " + selected_patient.last_name:
-                return selected_patient
-        return None
+        patients_with_name = self._patients_by_name.get(patient_name)
+        if patients_with_name is None:
+            return None
+        return next(iter(patients_with_name.values()))
+
+    def get_patient(self, patient_id):
+        """
+        Find patient with the given id
+        :param patient_id: id of the patient
+        :return: Patient object if matching patient found, None otherwise
+        """
+        return self._patients.get(patient_id)
 
     def calculate_avg_cholesterol(self):
         """
@@ -178,41 +492,91 @@ class PatientList:
         If patient has no cholesterol data, they are ignored
         :return: avg cholesterol
         """
-        total = 0
-        no_of_valid_patients = 0
-        for patient in self._patient_list:
-            try:
-                total += patient.get_cholesterol_data()[0]
-                no_of_valid_patients += 1
-            except AttributeError:
-                continue
-            except TypeError:
-                continue
-        if no_of_valid_patients == 0:
-            return 0
-        average = total/no_of_valid_patients
+        average = self._statistics["cholesterol"].get_mean()
         self.average_cholesterol_level = average
         return average
 
-    def attach(self, observer):
-        self._observers.append(observer)
+    def get_statistics(self, data_type):
+        """
+        Statistics of the patients' latest values, patients without data are ignored
+        :param data_type: "cholesterol", "systolic" or "diastolic"
+        :return: RunningStatistics object with the mean, variance, minimum and maximum
+        """
+        return self._statistics[data_type]
+
+    def attach(self, observer, changes=None):
+        """
+        Add an observer, notified of the changes of the given kinds
+        :param observer: Observer object
+        :param changes: kinds of change the observer is notified of, the observer's own changes attribute if None
+        :return: None
+        """
+        if changes is None:
+            changes = observer.changes
+        self._observers.append((observer, frozenset(changes)))
         observer.set_subject(self)
 
     def detach(self, observer):
-        self._observers.remove(observer)
+        self._observers = [(current, changes) for current, changes in self._observers if current is not observer]
         observer.set_subject(None)
 
+    def has_changes(self):
+        """
+        :return: True if there are changes which were not sent to the observers yet
+        """
+        return len(self._changes) > 0
+
     def notify(self):
-        for observer in self._observers:
+        """
+        Send the changes made since the last notify to the observers
+        Each observer is only updated with the patients whose changes are of the kinds it observes
+        :return: None
+        """
+        with self._lock:
+            changes = self._changes
+            self._changes = {}
+        if len(changes) == 0:
+            return
+
+        for observer, observed_changes in list(self._observers):
+            observer_changes = {}
+            for patient_id, patient_changes in changes.items():
+                if not observed_changes.isdisjoint(patient_changes):
+                    observer_changes[patient_id] = patient_changes & observed_changes
+            if len(observer_changes) == 0:
+                continue
             try:
-                observer.update()
-            except tk.TclError:
+                observer.update(observer_changes)
+            except tk.TclError:  # The observer's window was closed
                 self.detach(observer)
 
 
 class Address:
+    __slots__ = ("line", "city", "state", "country")
+
     def __init__(self, line, city, state, country):
         self.line = line
-        self.city = city
-        self.state = state
-        self.country = country
+        # Many patients share the same city, state and country
+        self.city = sys.intern(city)
+        self.state = sys.intern(state)
+        self.country = sys.intern(country)
+
+    def __getstate__(self):
+        return {"line": self.line, "city": self.city, "state": self.state, "country": self.country}
+
+    def __setstate__(self, state):
+        _set_state(self, state)
+
+
+def _set_state(obj, state):
+    """
+    Restore the attributes of an unpickled object with __slots__
+    :param obj: object being unpickled
+    :param state: dictionary of attributes, or (dictionary, slot values) for objects pickled with their slots
+    :return: None
+    """
+    if isinstance(state, tuple):
+        dictionary, slots = state
+        state = dict(dictionary or {}, **(slots or {}))
+    for name, value in state.items():
+        setattr(obj, name, value)
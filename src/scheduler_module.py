@@ -0,0 +1,271 @@
+import functools
+import heapq
+import itertools
+import statistics
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RefreshJob:
+    """
+    A task run by the RefreshScheduler at a fixed rate
+    """
+
+    def __init__(self, name, interval, task):
+        self.name = name
+        self.interval = interval
+        self.task = task
+        self.next_run = time.monotonic()
+        self.cancelled = threading.Event()
+        self.running = None  # future of the run in progress
+
+
+class RefreshScheduler:
+    """
+    Runs refresh jobs at fixed-rate ticks on a worker pool
+    Each job has its own interval, ticks are scheduled from the previous tick rather than from the end of the
+    previous run, so the period does not drift with the time spent fetching. A tick is skipped if the previous run
+    of the same job is still in progress. Between ticks the scheduler thread sleeps until the next job is due.
+    """
+
+    def __init__(self, max_workers=4):
+        """
+        :param max_workers: maximum number of jobs running at the same time
+        """
+        self._jobs = {}  # job name -> RefreshJob
+        self._queue = []  # heap of (next run, sequence, job)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """
+        Start the scheduler thread
+        :return: None
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Cancel every job and stop the scheduler thread
+        :return: None
+        """
+        self.cancel_all()
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._executor.shutdown(wait=False)
+
+    def schedule(self, name, interval, task):
+        """
+        Add a job, replacing and cancelling any job with the same name. The first run is immediate
+        :param name: name of the job
+        :param interval: seconds between two runs, must be positive
+        :param task: function called with a threading.Event which is set once the job is cancelled
+        :return: None
+        """
+        _check_interval(interval)
+        with self._condition:
+            self._cancel(name)
+            job = RefreshJob(name, interval, task)
+            self._jobs[name] = job
+            heapq.heappush(self._queue, (job.next_run, next(self._sequence), job))
+            self._condition.notify()
+
+    def set_interval(self, name, interval):
+        """
+        Change the interval of a job, the next run is moved relative to the last one
+        :param name: name of the job
+        :param interval: seconds between two runs, must be positive
+        :return: None
+        """
+        _check_interval(interval)
+        with self._condition:
+            job = self._jobs.get(name)
+            if job is not None and job.interval != interval:
+                job.next_run += interval - job.interval
+                job.interval = interval
+                heapq.heappush(self._queue, (job.next_run, next(self._sequence), job))
+                self._condition.notify()
+
+    def cancel(self, name):
+        """
+        Remove a job, a run in progress is told to stop through its cancel event
+        :param name: name of the job
+        :return: None
+        """
+        with self._condition:
+            self._cancel(name)
+
+    def cancel_all(self):
+        """
+        Remove every job
+        :return: None
+        """
+        with self._condition:
+            for name in list(self._jobs):
+                self._cancel(name)
+
+    def get_jobs(self):
+        """
+        :return: names of the scheduled jobs
+        """
+        with self._condition:
+            return list(self._jobs)
+
+    def _cancel(self, name):
+        job = self._jobs.pop(name, None)
+        if job is not None:
+            job.cancelled.set()
+            if job.running is not None:
+                job.running.cancel()  # Only stops runs which have not started yet
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                # Drop entries of cancelled jobs and entries made stale by an interval change
+                while len(self._queue) > 0:
+                    next_run, _, job = self._queue[0]
+                    if job.cancelled.is_set() or next_run != job.next_run:
+                        heapq.heappop(self._queue)
+                    else:
+                        break
+
+                if len(self._queue) == 0:
+                    self._condition.wait()
+                    continue
+
+                delay = self._queue[0][0] - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                _, _, job = heapq.heappop(self._queue)
+                if job.running is None or job.running.done():
+                    job.running = self._executor.submit(job.task, job.cancelled)
+                    job.running.add_done_callback(functools.partial(_report_failure, job.name))
+
+                # Fixed rate, skipping the ticks which were missed
+                now = time.monotonic()
+                job.next_run += job.interval
+                if job.next_run <= now:
+                    job.next_run += ((now - job.next_run) // job.interval + 1) * job.interval
+                heapq.heappush(self._queue, (job.next_run, next(self._sequence), job))
+
+
+def _report_failure(name, future):
+    """Print the exception of a failed run, nobody else reads the futures of the refresh jobs"""
+    if not future.cancelled() and future.exception() is not None:
+        exc = future.exception()
+        print("Refresh job " + str(name) + " failed:")
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+
+def _check_interval(interval):
+    """Raise a ValueError for intervals which would make a job run continuously"""
+    if interval <= 0:
+        raise ValueError("The interval of a refresh job must be positive, got " + str(interval))
+
+
+class AdaptivePollingPolicy:
+    """
+    Decides how often each patient's data of one type is requested
+    The longest interval of a patient is learned from how often their observations are made: a fraction of the
+    median time between their observations, kept within the bounds. A patient whose data did not change is polled
+    less often, up to that interval, a patient whose data changed is polled more often, down to the minimum
+    With the defaults, a patient observed every week is polled at least every minute, monthly every 4 minutes and
+    every 3 months every 13 minutes. Only cadences longer than about 14 months reach max_interval
+    """
+
+    def __init__(self, min_interval=5, max_interval=3600, cadence_fraction=0.0001, backoff=2, cadence_observations=20):
+        """
+        :param min_interval: shortest time in seconds between two requests for a patient
+        :param max_interval: longest time in seconds between two requests for a patient
+        :param cadence_fraction: fraction of the median time between observations used as the longest interval,
+        0.0001 polls a patient about 10000 times between two of their observations. The learned interval only has
+        an effect for median gaps between min_interval / cadence_fraction and max_interval / cadence_fraction
+        :param backoff: factor by which the interval grows when nothing changed, and shrinks when data changed
+        :param cadence_observations: number of latest observations requested to learn a patient's cadence
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.cadence_fraction = cadence_fraction
+        self.backoff = backoff
+        self.cadence_observations = cadence_observations
+        self._lock = threading.Lock()
+        self._intervals = {}  # patient id -> current interval
+        self._longest_intervals = {}  # patient id -> interval learned from the observation cadence
+        self._next_polls = {}  # patient id -> time of the next request
+        self._tolerance = 0.5  # patients due within this many seconds are polled on the current tick
+
+    def get_due_patients(self, patient_ids):
+        """
+        :param patient_ids: list of patient ids
+        :return: the patients which should be requested now
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [patient_id for patient_id in patient_ids
+                    if self._next_polls.get(patient_id, now) - now <= self._tolerance]
+
+    def set_cadence(self, patient_id, effective_dates):
+        """
+        Learn the longest interval of a patient from the dates of their observations
+        :param patient_id: patient's id
+        :param effective_dates: list of observation datetimes
+        :return: None
+        """
+        effective_dates = sorted(effective_dates)
+        gaps = [(later - earlier).total_seconds() for earlier, later in zip(effective_dates, effective_dates[1:])]
+        gaps = [gap for gap in gaps if gap > 0]
+        if len(gaps) == 0:
+            return
+
+        longest_interval = statistics.median(gaps) * self.cadence_fraction
+        with self._lock:
+            self._longest_intervals[patient_id] = min(max(longest_interval, self.min_interval), self.max_interval)
+
+    def has_cadence(self, patient_id):
+        """
+        :param patient_id: patient's id
+        :return: True if the patient's cadence was learned
+        """
+        with self._lock:
+            return patient_id in self._longest_intervals
+
+    def record_poll(self, patient_id, changed, poll_time=None):
+        """
+        Update the patient's interval after a request and schedule their next request
+        The next request is scheduled from the start of this one, so the time spent fetching does not push the
+        patient past the next tick of the refresh job
+        :param patient_id: patient's id
+        :param changed: whether the patient's data changed
+        :param poll_time: time.monotonic() taken before the request was sent, now if not given
+        :return: None
+        """
+        if poll_time is None:
+            poll_time = time.monotonic()
+        with self._lock:
+            longest_interval = self._longest_intervals.get(patient_id, self.max_interval)
+            interval = self._intervals.get(patient_id, self.min_interval)
+            if changed:
+                interval = max(interval / self.backoff, self.min_interval)
+            else:
+                interval = min(interval * self.backoff, longest_interval)
+            interval = min(max(interval, self.min_interval), self.max_interval)
+            self._intervals[patient_id] = interval
+            self._next_polls[patient_id] = poll_time + interval
+
+    def get_interval(self, patient_id):
+        """
+        :param patient_id: patient's id
+        :return: current time in seconds between two requests for the patient
+        """
+        with self._lock:
+            return self._intervals.get(patient_id, self.min_interval)
@@ -0,0 +1,219 @@
+import json
+import os
+import pickle
+import sqlite3
+import threading
+from datetime import date
+from src.patientdata_module import CholesterolData, BloodPressureData
+from src.person_module import Patient, HealthPractitioner, PatientList, Address
+
+
+class PractitionerStore:
+    """
+    Local SQLite storage for practitioners, their patients and the patients' latest observations
+    Rows are indexed by practitioner and patient id so a login only reads the practitioner's own patients,
+    and saving only writes the rows which changed since they were last loaded or saved
+    """
+
+    def __init__(self, filename, legacy_directory=None):
+        """
+        :param filename: path of the SQLite database file
+        :param legacy_directory: directory of pickled practitioners, imported the first time they are loaded
+        """
+        self._legacy_directory = legacy_directory
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._saved_rows = {}  # (table, key) -> row last read from or written to the database
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self._connection:
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS practitioner (
+                    id TEXT PRIMARY KEY,
+                    first_name TEXT,
+                    last_name TEXT
+                );
+                CREATE TABLE IF NOT EXISTS patient (
+                    id TEXT PRIMARY KEY,
+                    first_name TEXT,
+                    last_name TEXT,
+                    birth_date TEXT,
+                    gender TEXT,
+                    address_line TEXT,
+                    city TEXT,
+                    state TEXT,
+                    country TEXT
+                );
+                CREATE TABLE IF NOT EXISTS practitioner_patient (
+                    practitioner_id TEXT,
+                    patient_id TEXT,
+                    position INTEGER,
+                    PRIMARY KEY (practitioner_id, patient_id)
+                );
+                CREATE TABLE IF NOT EXISTS cholesterol (
+                    patient_id TEXT PRIMARY KEY,
+                    value,
+                    unit TEXT,
+                    effective_date TEXT
+                );
+                CREATE TABLE IF NOT EXISTS blood_pressure (
+                    patient_id TEXT,
+                    position INTEGER,
+                    systolic,
+                    diastolic,
+                    unit TEXT,
+                    effective_date TEXT,
+                    PRIMARY KEY (patient_id, position)
+                );
+            """)
+
+    def load_practitioner(self, practitioner_id):
+        """
+        Load a practitioner and their patients
+        :param practitioner_id: identifier
+        :return: HealthPractitioner object, None if the practitioner is not stored
+        """
+        practitioner_id = str(practitioner_id)
+        with self._lock:
+            practitioner_row = self._connection.execute(
+                "SELECT first_name, last_name FROM practitioner WHERE id = ?", (practitioner_id,)).fetchone()
+        if practitioner_row is None:
+            return self._import_legacy_practitioner(practitioner_id)
+
+        with self._lock:
+            patient_rows = self._connection.execute("""
+                SELECT patient.id, patient.first_name, patient.last_name, patient.birth_date, patient.gender,
+                       patient.address_line, patient.city, patient.state, patient.country,
+                       cholesterol.value, cholesterol.unit, cholesterol.effective_date
+                FROM practitioner_patient
+                JOIN patient ON patient.id = practitioner_patient.patient_id
+                LEFT JOIN cholesterol ON cholesterol.patient_id = patient.id
+                WHERE practitioner_patient.practitioner_id = ?
+                ORDER BY practitioner_patient.position
+            """, (practitioner_id,)).fetchall()
+            blood_pressure_rows = self._connection.execute("""
+                SELECT blood_pressure.patient_id, blood_pressure.systolic, blood_pressure.diastolic,
+                       blood_pressure.unit, blood_pressure.effective_date
+                FROM practitioner_patient
+                JOIN blood_pressure ON blood_pressure.patient_id = practitioner_patient.patient_id
+                WHERE practitioner_patient.practitioner_id = ?
+                ORDER BY blood_pressure.patient_id, blood_pressure.position
+            """, (practitioner_id,)).fetchall()
+
+        blood_pressure_data = {}
+        for patient_id, systolic, diastolic, unit, effective_date in blood_pressure_rows:
+            blood_pressure_data.setdefault(patient_id, []).append(
+                BloodPressureData(systolic, diastolic, unit, effective_date))
+
+        patient_list = PatientList()
+        for row in patient_rows:
+            patient_id, first_name, last_name, birth_date, gender, address_line, city, state, country = row[:9]
+            address = Address(json.loads(address_line), city, state, country)
+            patient = Patient(first_name, last_name, patient_id, date.fromisoformat(birth_date), gender, address)
+            if row[9] is not None:
+                patient.update_data(CholesterolData(row[9], row[10], row[11]))
+            if patient_id in blood_pressure_data:
+                patient.update_data(blood_pressure_data[patient_id])
+            patient_list.add_patient(patient)
+
+        # Remember what is stored so only changes are written back
+        practitioner = HealthPractitioner(practitioner_row[0], practitioner_row[1], practitioner_id, patient_list)
+        self._saved_rows.update(self._practitioner_rows(practitioner))
+        return practitioner
+
+    def save_practitioner(self, practitioner):
+        """
+        Write the practitioner and their patients, only the rows which changed are written
+        :param practitioner: HealthPractitioner object
+        :return: None
+        """
+        rows = self._practitioner_rows(practitioner)
+        changed_rows = {key: row for key, row in rows.items() if self._saved_rows.get(key) != row}
+
+        # Patients which are no longer in the practitioner's list
+        practitioner_id = str(practitioner.id)
+        removed_links = [key for key in self._saved_rows
+                         if key[0] == "practitioner_patient" and key[1][0] == practitioner_id and key not in rows]
+
+        if len(changed_rows) == 0 and len(removed_links) == 0:
+            return
+
+        with self._lock, self._connection:
+            for (table, key), row in changed_rows.items():
+                if table == "practitioner":
+                    self._connection.execute("INSERT OR REPLACE INTO practitioner VALUES (?, ?, ?)", (key,) + row)
+                elif table == "patient":
+                    self._connection.execute("INSERT OR REPLACE INTO patient VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                             (key,) + row)
+                elif table == "practitioner_patient":
+                    self._connection.execute("INSERT OR REPLACE INTO practitioner_patient VALUES (?, ?, ?)",
+                                             key + row)
+                elif table == "cholesterol":
+                    self._connection.execute("INSERT OR REPLACE INTO cholesterol VALUES (?, ?, ?, ?)", (key,) + row)
+                elif table == "blood_pressure":
+                    self._connection.execute("DELETE FROM blood_pressure WHERE patient_id = ?", (key,))
+                    self._connection.executemany("INSERT INTO blood_pressure VALUES (?, ?, ?, ?, ?, ?)",
+                                                 [(key, position) + data for position, data in enumerate(row)])
+
+            for key in removed_links:
+                self._connection.execute(
+                    "DELETE FROM practitioner_patient WHERE practitioner_id = ? AND patient_id = ?", key[1])
+
+        self._saved_rows.update(changed_rows)
+        for key in removed_links:
+            del self._saved_rows[key]
+
+    def close(self):
+        """
+        Close the database connection
+        :return: None
+        """
+        with self._lock:
+            self._connection.close()
+
+    def _import_legacy_practitioner(self, practitioner_id):
+        """
+        Load a practitioner from the pickle files used before the database, and store them in the database
+        :param practitioner_id: identifier
+        :return: HealthPractitioner object, None if there is no pickle file for the practitioner
+        """
+        if self._legacy_directory is None:
+            return None
+        filename = os.path.join(self._legacy_directory, practitioner_id)
+        try:
+            file = open(filename, 'rb')
+        except FileNotFoundError:
+            return None
+        practitioner = pickle.load(file)
+        file.close()
+
+        self.save_practitioner(practitioner)
+        return practitioner
+
+    @staticmethod
+    def _practitioner_rows(practitioner):
+        """
+        Convert a practitioner and their patients into database rows
+        :param practitioner: HealthPractitioner object
+        :return: dictionary of (table, key) -> row values without the key
+        """
+        practitioner_id = str(practitioner.id)
+        rows = {("practitioner", practitioner_id): (practitioner.first_name, practitioner.last_name)}
+        if practitioner.get_all_patients() is None:
+            return rows
+
+        for position, patient in enumerate(practitioner.get_all_patients().get_patient_list()):
+            patient_id = str(patient.id)
+            rows[("practitioner_patient", (practitioner_id, patient_id))] = (position,)
+
+            address = patient.address
+            rows[("patient", patient_id)] = (patient.first_name, patient.last_name, patient.birth_date.isoformat(),
+                                             patient.gender, json.dumps(address.line), address.city, address.state,
+                                             address.country)
+            if patient.cholesterol_data is not None:
+                rows[("cholesterol", patient_id)] = patient.get_cholesterol_data()
+            if patient.blood_pressure_data is not None:
+                rows[("blood_pressure", patient_id)] = tuple(
+                    patient.get_blood_pressure_data(i) for i in range(len(patient.blood_pressure_data)))
+        return rows
@@ -0,0 +1,59 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HTTPTransport:
+    """
+    Shared HTTP layer used by the FHIR and machine learning clients
+    Keeps connections to the server alive in a pool so repeated requests reuse the same TCP/TLS connection,
+    and retries failed requests with an exponential backoff
+    """
+
+    def __init__(self, pool_size=10, timeout=(5, 30), retries=3, backoff_factor=0.5):
+        """
+        :param pool_size: maximum number of connections kept open per host
+        :param timeout: (connect, read) timeout in seconds for every request
+        :param retries: number of times a failed request is retried
+        :param backoff_factor: base delay in seconds between retries, doubled after each attempt
+        """
+        self._timeout = timeout
+        # POST is retried too, the only POST requests are batch Bundles of searches which are safe to send again.
+        # urllib3 1.26 renamed method_whitelist to allowed_methods
+        methods_argument = "allowed_methods" if hasattr(Retry, "DEFAULT_ALLOWED_METHODS") else "method_whitelist"
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                      **{methods_argument: frozenset({"GET", "POST"})})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update({"Accept": "application/fhir+json",
+                                      "Accept-Encoding": "gzip, deflate"})
+
+    def get(self, url, **kwargs):
+        """
+        Send a GET request through the connection pool
+        :param url: url to request
+        :param kwargs: extra arguments passed on to requests
+        :return: requests Response object
+        """
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """
+        Send a POST request through the connection pool
+        :param url: url to request
+        :param kwargs: extra arguments passed on to requests, such as json
+        :return: requests Response object
+        """
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.post(url, **kwargs)
+
+    def close(self):
+        """
+        Close all pooled connections
+        :return: None
+        """
+        self._session.close()
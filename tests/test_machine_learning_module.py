@@ -0,0 +1,125 @@
+import math
+import os
+import shutil
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+import pytest
+from src.machine_learning_module import MachineLearningClient, read_ndjson, pivot_patient_data, \
+    get_effective_time
+
+EXPORT_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "bulk_export")
+DATA_CODES = ["55284-4", "2339-0", "72166-2", "39156-5", "2947-0", "29463-7", "2093-3"]
+
+
+class FixtureResponse:
+    def __init__(self, data):
+        self._data = data
+
+    def json(self):
+        return self._data
+
+
+class FixtureTransport:
+    """
+    Answers the per-patient Observation searches of MachineLearningClient.get_data_values from the observations
+    of the export fixture, sorted by decreasing date like the server
+    """
+
+    def __init__(self, export_dir):
+        self._observations = [resource for file_name in sorted(os.listdir(export_dir))
+                              for resource in read_ndjson(os.path.join(export_dir, file_name))
+                              if resource["resourceType"] == "Observation"]
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        query = parse_qs(urlparse(url).query)
+        patient_id = query["patient"][0]
+        codes = query["code"][0].split(",")
+        matches = [resource for resource in self._observations
+                   if resource["subject"]["reference"] == "Patient/" + patient_id
+                   and any(coding["code"] in codes for coding in resource["code"]["coding"])]
+        matches.sort(key=get_effective_time, reverse=True)
+        return FixtureResponse({"resourceType": "Bundle", "entry": [{"resource": resource} for resource in matches]})
+
+
+@pytest.fixture
+def working_dir(tmp_path, monkeypatch):
+    """Working directory with the Machine Learning Data folder the client reads and writes"""
+    data_dir = tmp_path / "Machine Learning Data"
+    data_dir.mkdir()
+    (data_dir / "data_codes.csv").write_text("DATA CODES\n" + "\n".join(DATA_CODES) + "\n")
+    (data_dir / "patient_ids.csv").write_text("PATIENT ID\np1\np2\np3\n")
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_read_ndjson_skips_blank_lines():
+    resources = list(read_ndjson(os.path.join(EXPORT_DIR, "Observation.1.ndjson")))
+    assert len(resources) == 11
+    assert all(resource["resourceType"] == "Observation" for resource in resources)
+
+    patients = list(read_ndjson(os.path.join(EXPORT_DIR, "Patient.0.ndjson")))
+    assert [patient["id"] for patient in patients] == ["p1", "p2", "p3"]
+
+
+def test_bulk_data_set_matches_per_patient_searches(working_dir):
+    transport = FixtureTransport(EXPORT_DIR)
+    client = MachineLearningClient("http://fixture/", max_workers=2, transport=transport)
+
+    client.data_chart(resume=False)
+    per_patient = client.get_data_values_array()
+    assert transport.requests == 3
+
+    export_dir = str(working_dir / "export")
+    shutil.copytree(EXPORT_DIR, export_dir)
+    bulk = client.bulk_data_set(export_dir)
+
+    assert list(bulk.index) == ["p1", "p2", "p3"]
+    assert list(bulk.columns) == list(per_patient.columns)
+    np.testing.assert_array_equal(bulk.to_numpy(), per_patient.to_numpy())
+
+    # Latest values win, missing codes are NaN and patients outside the export are left out
+    assert bulk.loc["p1", "CHOLESTEROL"] == 201.2
+    assert bulk.loc["p1", "TOBACCO INTAKE"] == 8517006
+    assert bulk.loc["p2", "BLOOD PRESSURE"] == 128
+    assert math.isnan(bulk.loc["p2", "GLUCOSE"])
+    assert bulk.loc["p3"].isna().sum() == len(DATA_CODES) - 1
+
+
+def test_bulk_data_set_is_reloaded_from_cache(working_dir):
+    client = MachineLearningClient("http://fixture/", transport=FixtureTransport(EXPORT_DIR))
+    export_dir = str(working_dir / "export")
+    shutil.copytree(EXPORT_DIR, export_dir)
+    bulk = client.bulk_data_set(export_dir)
+
+    loaded = client.load_data_set()
+    pd.testing.assert_frame_equal(loaded, bulk, check_index_type=False)
+
+
+def test_pivot_patient_data_keeps_last_row():
+    patient_data = pd.DataFrame([("p1", "Total Cholesterol", "180", "2093-3"),
+                                 ("p1", "Total Cholesterol", "190", "2093-3"),
+                                 ("p1", "No Data", "0", "2339-0"),
+                                 ("p2", "Heart rate", "72", "8867-4")],
+                                columns=["PATIENT ID", "DIAGNOSTIC DESCRIPTION", "VALUE", "DATA CODE"])
+    data_set = pivot_patient_data(patient_data, DATA_CODES)
+
+    assert list(data_set.index) == ["p1", "p2"]
+    assert data_set.loc["p1", "CHOLESTEROL"] == 190
+    assert math.isnan(data_set.loc["p1", "GLUCOSE"])
+    assert data_set.loc["p2"].isna().all()
+
+
+def test_data_set_csv_is_only_written_on_demand(working_dir):
+    client = MachineLearningClient("http://fixture/", transport=FixtureTransport(EXPORT_DIR))
+    client.data_chart(resume=False)
+    csv_path = working_dir / "Machine Learning Data" / "patient_data_set.csv"
+
+    data_set = client.get_data_values_array()
+    assert not csv_path.exists()
+
+    client.export_data_set_csv()
+    written = pd.read_csv(csv_path, index_col="PATIENT ID", dtype={"PATIENT ID": str})
+    np.testing.assert_array_equal(written.to_numpy(), data_set.fillna(0).to_numpy())